@@ -0,0 +1,636 @@
+"""
+Benchmark of the Trip Split flows.
+Each flow runs against an in-memory stand-in for the 'trip_split'
+spreadsheet, with inputs typed from a script, and reports the wall
+time, the number of Google Sheets requests and the peak memory for
+trips of different sizes. It exits with status 1 when a flow makes
+more requests than its budget.
+
+Usage: python benchmark.py [--sizes 10 1000] [--latency 0.1]
+"""
+import argparse
+import builtins
+import collections
+import contextlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+from tabulate import tabulate
+from colorama import Fore
+
+import run
+
+# Trip sizes, in entries, benchmarked when none are given.
+SIZES = [10, 100, 1000, 10000, 100000]
+
+# Name of the trip the flows work on.
+TRIP = "Benchmark"
+
+# Maximum number of Google Sheets requests made by each flow, with
+# the journal on as in the app. Flows only read and write the rows
+# they change, so the budgets don't depend on the trip size. Writes
+# addressing entries by row number are preceded by a read of the
+# spreadsheet modified time. Lower them when a flow improves.
+BUDGETS = {
+    "create_new_trip": 5,
+    "create_expense": 6,
+    "edit_trip_entry": 8,
+    "delete_trip_entry": 8,
+    "see_trip_summary": 3,
+    "load_trips": 4,
+    "archive_trip": 4
+}
+
+# time.sleep is replaced while the flows run, so that the pauses
+# between screens, the throttling and the retries don't slow down the
+# benchmark. The injected latency still has to wait for real.
+real_sleep = time.sleep
+
+# Requests to the fake spreadsheet taking a read quota token.
+# Any other request takes a write token.
+READ_REQUESTS = {
+    "worksheets",
+    "worksheet",
+    "values_batch_get",
+    "refresh_lastUpdateTime",
+    "get_all_values",
+    "get",
+    "acell",
+    "row_values"
+}
+
+
+class EndOfScript(Exception):
+    """
+    Raised when a flow asks for more input than its script has.
+    """
+
+
+class Clock:
+    """
+    Virtual clock moved forward by the replaced time.sleep,
+    so that the quota of the fake spreadsheet is refilled
+    by the backoff of the retried requests.
+    """
+    def __init__(self):
+        """
+        Initialize the clock with no time slept.
+        """
+        self.slept = 0.0
+
+    def sleep(self, seconds):
+        """
+        Move the clock forward instead of waiting.
+        """
+        self.slept += max(0.0, seconds)
+
+    def now(self):
+        """
+        Return the monotonic time plus the time slept.
+        """
+        return time.monotonic() + self.slept
+
+
+def cell_index(label):
+    """
+    Return the 0-based (row, column) of a cell label such as 'K1'.
+    """
+    match = re.fullmatch(r"([A-Z]+)(\d+)", label)
+    column = 0
+    for letter in match.group(1):
+        column = column * 26 + ord(letter) - ord("A") + 1
+    return int(match.group(2)) - 1, column - 1
+
+
+def trim(row):
+    """
+    Return the row without trailing empty cells, as the Sheets API does.
+    """
+    row = list(row)
+    while row and row[-1] == "":
+        row.pop()
+    return row
+
+
+def render(rows, value_render_option=None, date_time_render_option=None):
+    """
+    Return the rows as Google Sheets returns them: as they were saved
+    if read UNFORMATTED_VALUE, or else as strings.
+    """
+    if value_render_option == "UNFORMATTED_VALUE":
+        return [list(row) for row in rows]
+    return [[str(value) for value in row] for row in rows]
+
+
+class FakeCell:
+    """
+    Cell returned by FakeWorksheet.acell.
+    """
+    def __init__(self, value):
+        """
+        Initialize the cell with its value, None if it's empty.
+        """
+        self.value = value or None
+
+
+class FakeWorksheet:
+    """
+    In-memory stand-in for a gspread Worksheet.
+    Cells keep the values written RAW: numbers stay numbers.
+    """
+    def __init__(
+        self, book, title, rows=100, cols=20, values=(), frozen_rows=0
+    ):
+        """
+        Initialize the worksheet with a list of rows.
+        """
+        self.book = book
+        self.title = title
+        self.id = max(
+            (worksheet.id for worksheet in book.sheets), default=-1
+        ) + 1  # Ids aren't reused once a worksheet is deleted
+        self.values = [list(row) for row in values]
+        self.row_count = max(rows, len(self.values))
+        self.col_count = max([cols] + [len(row) for row in self.values])
+        self.frozen_row_count = frozen_rows
+
+    def set_cell(self, row, column, value):
+        """
+        Write one cell, growing the grid if needed.
+        """
+        while len(self.values) <= row:
+            self.values.append([])
+        cells = self.values[row]
+        if len(cells) <= column:
+            cells.extend([""] * (column + 1 - len(cells)))
+        cells[column] = value
+
+    def write(self, label, rows):
+        """
+        Write the rows starting at the cell with the given label.
+        """
+        first_row, first_column = cell_index(label.split(":")[0])
+        for row_offset, row in enumerate(rows):
+            for column_offset, value in enumerate(row):
+                self.set_cell(
+                    first_row + row_offset, first_column + column_offset, value
+                )
+        self.row_count = max(self.row_count, len(self.values))
+        self.col_count = max(
+            [self.col_count] + [len(row) for row in self.values]
+        )  # The grid grows to fit the values written
+        self.book.version += 1
+
+    def get_all_values(self, **options):
+        self.book.request("get_all_values")
+        width = max((len(row) for row in self.values), default=0)
+        return render(
+            [row + [""] * (width - len(row)) for row in self.values],
+            **options
+        )
+
+    def get(self, range_label, **options):
+        self.book.request("get")
+        first, last = (range_label.split(":") + [range_label])[:2]
+        first_row, first_column = cell_index(first)
+        last_row, last_column = cell_index(last)
+        return render(trim(
+            trim(row[first_column:last_column + 1])
+            for row in self.values[first_row:last_row + 1]
+        ), **options)
+
+    def acell(self, label, value_render_option=None):
+        self.book.request("acell")
+        row, column = cell_index(label)
+        cells = self.values[row] if row < len(self.values) else []
+        return FakeCell(cells[column] if column < len(cells) else "")
+
+    def row_values(self, row_number, **options):
+        self.book.request("row_values")
+        if row_number > len(self.values):
+            return []
+        return render([trim(self.values[row_number - 1])], **options)[0]
+
+    def update(self, range_label, values, value_input_option="RAW"):
+        self.book.request("update")
+        self.write(range_label, values)
+
+    def batch_update(self, data, value_input_option="RAW"):
+        self.book.request("batch_update")
+        for value_range in data:
+            self.write(value_range["range"], value_range["values"])
+
+    def append_rows(
+        self, rows, value_input_option="RAW", table_range="A:G"
+    ):
+        self.book.request("append_rows")
+        last_column = cell_index(table_range.split(":")[1] + "1")[1]
+        row_number = len(self.values)
+        while row_number and all(
+            value == ""
+            for value in self.values[row_number - 1][:last_column + 1]
+        ):
+            row_number -= 1  # Rows past the end of the table are reused
+        self.write(f"A{row_number + 1}", rows)
+
+    def delete_rows(self, start_index, end_index=None):
+        self.book.request("delete_rows")
+        del self.values[start_index - 1:end_index or start_index]
+        self.book.version += 1
+
+
+class FakeSpreadsheet:
+    """
+    In-memory stand-in for the gspread Spreadsheet.
+    Every request waits the given latency and counts against a read
+    or write quota per minute. Requests over quota fail with 429,
+    as the Sheets API does. A quota of 0 disables the limit.
+    """
+    def __init__(self, clock, latency=0.0, read_quota=60, write_quota=60):
+        """
+        Initialize the spreadsheet with the 'currency_exchange' worksheet.
+        """
+        self.clock = clock
+        self.latency = latency
+        self.quotas = {"read": read_quota, "write": write_quota}
+        self.sent = {"read": collections.deque(), "write": collections.deque()}
+        self.requests = collections.Counter()
+        self.version = 0
+        self.sheets = []
+        self.sheets.append(FakeWorksheet(self, "currency_exchange", values=[
+            ["currency_base", "currency_base_amount",
+             "currency_other", "currency_other_amount"]
+        ] + [
+            [base, 1, other, rate]
+            for (base, other), rate in run.DEFAULT_RATES.items()
+        ]))
+
+    def request(self, name):
+        """
+        Count a request, waiting the latency first.
+        Raise APIError 429 if the quota of the last minute is used up.
+        """
+        kind = "read" if name in READ_REQUESTS else "write"
+        real_sleep(self.latency)
+        now = self.clock.now()
+        sent = self.sent[kind]
+        while sent and now - sent[0] >= 60:
+            sent.popleft()
+        if self.quotas[kind] and len(sent) >= self.quotas[kind]:
+            self.requests["over_quota"] += 1
+            raise quota_error()
+        sent.append(now)
+        self.requests[kind] += 1
+        self.requests[name] += 1
+
+    @property
+    def lastUpdateTime(self):
+        return str(self.version)
+
+    def refresh_lastUpdateTime(self):
+        self.request("refresh_lastUpdateTime")
+
+    def worksheets(self):
+        self.request("worksheets")
+        return list(self.sheets)
+
+    def worksheet(self, title):
+        from gspread.exceptions import WorksheetNotFound
+
+        self.request("worksheet")
+        for worksheet in self.sheets:
+            if worksheet.title == title:
+                return worksheet
+        raise WorksheetNotFound(title)
+
+    def add_worksheet(self, title, rows, cols):
+        self.request("add_worksheet")
+        worksheet = FakeWorksheet(self, title, rows, cols)
+        self.sheets.append(worksheet)
+        self.version += 1
+        return worksheet
+
+    def del_worksheet(self, worksheet):
+        self.request("del_worksheet")
+        self.sheets.remove(worksheet)
+        self.version += 1
+
+    def batch_update(self, body):
+        self.request("batch_update")
+        for request in body["requests"]:
+            if "updateCells" in request:
+                update = request["updateCells"]
+                worksheet = self.sheet_by_id(update["start"]["sheetId"])
+                worksheet.write("A1", [
+                    [
+                        next(iter(cell["userEnteredValue"].values()))
+                        for cell in row["values"]
+                    ]
+                    for row in update["rows"]
+                ])
+            elif "deleteDimension" in request:
+                dimension_range = request["deleteDimension"]["range"]
+                worksheet = self.sheet_by_id(dimension_range["sheetId"])
+                del worksheet.values[
+                    dimension_range["startIndex"]:dimension_range["endIndex"]
+                ]
+            elif "updateSheetProperties" in request:
+                properties = request["updateSheetProperties"]["properties"]
+                worksheet = self.sheet_by_id(properties["sheetId"])
+                grid = properties["gridProperties"]
+                worksheet.frozen_row_count = grid.get(
+                    "frozenRowCount", worksheet.frozen_row_count
+                )
+                if "rowCount" in grid:
+                    worksheet.row_count = grid["rowCount"]
+                    worksheet.col_count = grid["columnCount"]
+                    del worksheet.values[worksheet.row_count:]
+                    for row in worksheet.values:
+                        del row[worksheet.col_count:]
+            # Formats, such as repeatCell requests, aren't kept
+        self.version += 1
+        return {}
+
+    def sheet_by_id(self, sheet_id):
+        """
+        Return the worksheet with the given id, without a request.
+        """
+        return next(
+            worksheet for worksheet in self.sheets if worksheet.id == sheet_id
+        )
+
+    def values_batch_get(self, ranges, params=None):
+        self.request("values_batch_get")
+        value_ranges = []
+        for range_label in ranges:
+            title = range_label.rsplit("!", 1)[0][1:-1].replace("''", "'")
+            worksheet = next(
+                worksheet for worksheet in self.sheets
+                if worksheet.title == title
+            )
+            value_ranges.append({
+                "range": range_label,
+                "values": render(
+                    [trim(row[:11]) for row in worksheet.values],
+                    (params or {}).get("valueRenderOption")
+                )
+            })  # Columns A:K
+        return {"valueRanges": value_ranges}
+
+
+def quota_error():
+    """
+    Return the APIError raised by the Sheets API when over quota.
+    """
+    from gspread.exceptions import APIError
+    from requests import Response
+
+    response = Response()
+    response.status_code = 429
+    response._content = json.dumps({"error": {
+        "code": 429,
+        "message": "Quota exceeded",
+        "status": "RESOURCE_EXHAUSTED"
+    }}).encode()
+    return APIError(response)
+
+
+def trip_values(size):
+    """
+    Return the rows of a trip with the given number of entries,
+    header included, and its base currency and running totals
+    in J1 and K1. Values are typed, as the app saves them.
+    """
+    generator = random.Random(size)
+    names = ["Ann", "Bob", "Carla", "Dev", "Eve"]
+    start = (date(2023, 1, 1) - run.SERIAL_EPOCH).days
+    rows = [list(run.HEADER)]
+    for entry in range(size):
+        currency = generator.choice(list(run.CURRENCIES.values()))
+        cost = round(generator.uniform(1, 200), 2)
+        rows.append([
+            start + entry % 365,
+            generator.choice(names),
+            generator.choice(list(run.CONCEPTS.values())),
+            cost,
+            currency,
+            round(cost * run.DEFAULT_RATES[(currency, "EUR")], 2),
+            "EUR"
+        ])
+    totals = run.ExpenseBatch.from_values(rows).totals()
+    rows[0] += ["", "", "EUR", json.dumps(totals)]
+    return rows
+
+
+def flows(size):
+    """
+    Return the flows run on a trip with the given number of entries.
+    Each flow is the first screen, as run_screens takes it,
+    and the inputs typed on it.
+    """
+    entry = size // 2
+    return {
+        "create_new_trip": (
+            (run.create_new_trip, "New trip"), ["1", "n"]
+        ),
+        "create_expense": (
+            (run.create_expense, TRIP),
+            ["05/01/2023", "Ann", "2", "19.95", "2", "y"]
+        ),
+        "edit_trip_entry": (
+            (run.edit_trip_entry, TRIP, entry), ["cost", "25", "y"]
+        ),
+        "delete_trip_entry": (
+            (run.delete_trip_entry, TRIP, entry), ["y"]
+        ),
+        "see_trip_summary": (
+            (run.select_trip, TRIP), ["1", ""]
+        ),
+        "load_trips": (
+            (run.load_trips,), ["1"]
+        ),
+        "archive_trip": (
+            (run.archive_trip, TRIP), ["y"]
+        )
+    }
+
+
+def run_flow(screen, inputs, values, args, measure_memory=False):
+    """
+    Run a flow on a new spreadsheet holding a copy of the trip values.
+    Return the seconds it took, the spreadsheet request counters,
+    the scheduler counters and the peak memory in bytes.
+    """
+    clock = Clock()
+    book = FakeSpreadsheet(
+        clock, args.latency, args.read_quota, args.write_quota
+    )
+    book.sheets.append(FakeWorksheet(
+        book, TRIP, values=values, frozen_rows=1
+    ))  # Created by the current version, so already formatted
+    script = iter(inputs)
+
+    def scripted_input(prompt=""):
+        for line in script:
+            return line
+        raise EndOfScript(prompt)
+
+    run.SHEET = book
+    journal_dir = tempfile.TemporaryDirectory()
+    run.STORAGE = run.JournalStorage(
+        run.SheetsStorage(), os.path.join(journal_dir.name, "journal")
+    )  # Wrapped as main() does by default
+    run.SCHEDULER = run.RequestScheduler(
+        args.read_quota or run.SHEETS_READ_QUOTA,
+        args.write_quota or run.SHEETS_WRITE_QUOTA
+    )  # Spaces the requests as the app does with the same quota
+    run.EXCHANGE_RATES = run.ExchangeRates()
+    run.PREFETCHER = run.Prefetcher()
+    builtins.input = scripted_input
+    time.sleep = clock.sleep
+    run.clear_terminal = lambda: None
+    archive_dir = tempfile.TemporaryDirectory()
+    run.ARCHIVE_DIR = archive_dir.name  # Archived trips aren't kept
+    peak = None
+    try:
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            if measure_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            try:
+                run.run_screens(*screen)
+            except EndOfScript:
+                pass  # The flow is over when it asks for more input
+            for future in list(run.PREFETCHER.futures.values()):
+                future.result()
+            seconds = time.perf_counter() - start
+            if measure_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+    finally:
+        run.PREFETCHER.cancel()
+        time.sleep = real_sleep
+        archive_dir.cleanup()
+        run.STORAGE.journal.compact()  # Closes the file
+        journal_dir.cleanup()
+    if next(script, None) is not None:
+        raise RuntimeError("The flow ended before its script.")
+    return seconds, book.requests, run.SCHEDULER.counters, peak
+
+
+def benchmark(args):
+    """
+    Run every flow at every size, print the results and return
+    the flows making more requests than their budget.
+    """
+    results = []
+    over_budget = set()
+    for screen, inputs in flows(10).values():
+        run_flow(
+            screen, inputs, trip_values(10), args
+        )  # Warm up, so that the modules imported on demand aren't timed
+    for size in args.sizes:
+        values = trip_values(size)
+        for name, (screen, inputs) in flows(size).items():
+            if args.flows and name not in args.flows:
+                continue
+            seconds, requests, counters, _ = run_flow(
+                screen, inputs, values, args
+            )
+            *_, peak = run_flow(
+                screen, inputs, values, args, measure_memory=True
+            )  # tracemalloc slows down the flow, so it's timed apart
+            calls = requests["read"] + requests["write"]
+            within_budget = calls <= BUDGETS[name]
+            if not within_budget:
+                over_budget.add(name)
+            results.append((
+                name,
+                size,
+                f"{seconds * 1000:.1f}",
+                f"{calls} ({requests['read']}/{requests['write']})",
+                f"{counters['throttled']}/{counters['retried']}",
+                f"{peak / 2 ** 20:.1f}",
+                BUDGETS[name] if within_budget
+                else Fore.RED + f"{BUDGETS[name]} exceeded" + Fore.RESET
+            ))
+    print(
+        tabulate(
+            results,
+            headers=[
+                "Flow",
+                "Entries",
+                "Time (ms)",
+                "Requests (read/write)",
+                "Throttled/retried",
+                "Peak memory (MB)",
+                "Budget"
+            ],
+            tablefmt="mixed_grid"
+        )
+    )
+    return over_budget
+
+
+def main():
+    """
+    Run the benchmark.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Trip Split flows against "
+        "an in-memory Google Sheets."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=SIZES,
+        help="number of entries of the benchmarked trip "
+        "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--flows",
+        nargs="+",
+        choices=list(BUDGETS),
+        help="flows to run (default: all)"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds each Google Sheets request takes (default: 0)"
+    )
+    parser.add_argument(
+        "--read-quota",
+        type=int,
+        default=60,
+        help="read requests allowed per minute, 0 for no limit "
+        "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--write-quota",
+        type=int,
+        default=60,
+        help="write requests allowed per minute, 0 for no limit "
+        "(default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    over_budget = benchmark(args)
+    if over_budget:
+        print(
+            Fore.RED + "Over the request budget: "
+            + ", ".join(sorted(over_budget))
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,29 @@
-import gspread
-from google.oauth2.service_account import Credentials
+import argparse
+import atexit
+import bisect
+import copy
+import csv
+import functools
+import gzip
+import heapq
+import importlib
+import json
+import math
 import os
+import random
+import threading
 from tabulate import tabulate
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
 import time
-import pandas as pd
 import colorama
-import pyfiglet
 from colorama import Fore
 import warnings
 
+# gspread, google-auth, pandas and pyfiglet are slow to import, so they
+# are imported inside the functions that need them. This keeps the time
+# until the welcome banner is displayed as short as possible.
+
 # Every Google account has as an IAM (Identity and Access Management)
 # configuration which specifies what the user has access to.
 # The SCOPE lists the APIs that the program should access in order to run.
@@ -20,15 +34,668 @@ SCOPE = [
     "https://www.googleapis.com/auth/drive"
     ]
 
-CREDS = Credentials.from_service_account_file("creds.json")
-SCOPED_CREDS = CREDS.with_scopes(SCOPE)
-GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
-SHEET = GSPREAD_CLIENT.open("trip_split")
+SHEET = None  # Opened on first use by get_sheet()
+
+# Modules imported on demand, reported by the --startup-profile option.
+# The Google Sheets ones are only imported with the sheets storage.
+SHEETS_MODULES = [
+    "gspread",
+    "google.oauth2.service_account"
+]
+LAZY_MODULES = [
+    "pandas",
+    "pyfiglet"
+]
 
 colorama.init(autoreset=True)  # Initialize colorama
 
 warnings.simplefilter("ignore")  # Avoid printing deprecation message
 
+# Number of seconds the exchange rates are kept in memory before
+# the 'currency_exchange' worksheet is read again.
+RATES_TTL = int(os.environ.get("TRIP_SPLIT_RATES_TTL", 3600))
+
+# Storage backend used when none is given on the command line:
+# "sheets" for Google Sheets or "sqlite" for a local database file.
+STORAGE_BACKEND = os.environ.get("TRIP_SPLIT_STORAGE", "sheets")
+SQLITE_PATH = os.environ.get("TRIP_SPLIT_DB", "trip_split.db")
+
+# Write-behind buffering of new and edited expenses. When enabled the
+# pending rows are saved together once there are WRITE_BEHIND_MAX_ROWS
+# of them or the oldest one has waited WRITE_BEHIND_MAX_AGE seconds.
+WRITE_BEHIND = os.environ.get("TRIP_SPLIT_WRITE_BEHIND", "") == "1"
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get("TRIP_SPLIT_MAX_PENDING", 20))
+WRITE_BEHIND_MAX_AGE = int(os.environ.get("TRIP_SPLIT_MAX_PENDING_AGE", 60))
+
+# Journal file where every change is recorded before it is sent to
+# Google Sheets, so that changes interrupted by a crash or a network
+# outage are sent on the next start. An empty value disables it.
+JOURNAL_PATH = os.environ.get("TRIP_SPLIT_JOURNAL", "trip_split.journal")
+
+# Folder where archived trips are saved, one gzip compressed JSON Lines
+# file per trip, once they are removed from the storage.
+ARCHIVE_DIR = os.environ.get("TRIP_SPLIT_ARCHIVE_DIR", "trip_split_archive")
+
+DATE_FORMAT = "%d/%m/%Y"
+
+# Dates are saved as serial numbers, the days since SERIAL_EPOCH,
+# which is how Google Sheets stores dates: 45000 is 15/03/2023.
+SERIAL_EPOCH = date(1899, 12, 30)
+
+# Google Sheets values are read unformatted, so that numbers come back
+# as numbers and dates as serial numbers whatever the spreadsheet
+# locale, and written RAW, so that they are saved as they are sent.
+RENDER_OPTIONS = {
+    "value_render_option": "UNFORMATTED_VALUE",
+    "date_time_render_option": "SERIAL_NUMBER"
+}
+BATCH_GET_PARAMS = {
+    "valueRenderOption": "UNFORMATTED_VALUE",
+    "dateTimeRenderOption": "SERIAL_NUMBER"
+}
+
+CONCEPTS = {
+    1: "Travel",
+    2: "Meals",
+    3: "Accomodation",
+    4: "Supermarket",
+    5: "Shopping",
+    6: "Other"
+}
+
+# Currencies listed first in the currency picker. Any other currency
+# with an exchange rate can be chosen too.
+CURRENCIES = {
+    1: "EUR",
+    2: "GBP",
+    3: "USD"
+}
+
+# Currency the 'currency_exchange' rates are given against. The rate
+# between two other currencies is calculated through it.
+PIVOT_CURRENCY = os.environ.get("TRIP_SPLIT_PIVOT_CURRENCY", "EUR")
+
+# Number of currencies on each page of the currency picker.
+CURRENCY_PAGE_SIZE = 10
+
+# Number of entries on each page of the trip entries.
+ENTRY_PAGE_SIZE = 20
+
+# Minimum number of seconds between two checks of the spreadsheet
+# modified time, used to find out if the local trip snapshots are stale.
+SNAPSHOT_CHECK_INTERVAL = int(
+    os.environ.get("TRIP_SPLIT_CHECK_INTERVAL", 10)
+)
+
+# Maximum number of worksheets read in a single values_batch_get request.
+BATCH_GET_RANGES = 100
+
+# Google Sheets allows 60 read and 60 write requests per minute and user.
+# Requests are spaced to stay within these quotas, and the ones rejected
+# for being over quota (429) or by a server error (5xx) are sent again
+# after an exponential backoff, up to SHEETS_MAX_RETRIES times.
+SHEETS_READ_QUOTA = int(os.environ.get("TRIP_SPLIT_READ_QUOTA", 60))
+SHEETS_WRITE_QUOTA = int(os.environ.get("TRIP_SPLIT_WRITE_QUOTA", 60))
+SHEETS_MAX_RETRIES = int(os.environ.get("TRIP_SPLIT_MAX_RETRIES", 5))
+SHEETS_BACKOFF_BASE = 1  # Seconds before the first retry
+SHEETS_BACKOFF_MAX = 32
+
+# Number of background threads reading the trips and exchange rates
+# while the user chooses a trip from the list. 0 disables the prefetch.
+PREFETCH_WORKERS = int(os.environ.get("TRIP_SPLIT_PREFETCH_WORKERS", 4))
+
+# File where --profile writes the requests and actions of the session,
+# in the trace event format read by chrome://tracing and Perfetto.
+PROFILE_PATH = os.environ.get("TRIP_SPLIT_PROFILE", "trip_split_profile.json")
+
+# Upper bounds, in milliseconds, of the request latency histogram
+# buckets. Slower requests go to a last bucket.
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+HEADER = [
+    "Date",
+    "Name",
+    "Concept",
+    "Cost",
+    "Currency",
+    "Cost_chosen_currency",
+    "Chosen_currency"
+]
+
+# Columns of a trip worksheet: the HEADER columns, two empty ones
+# and the currency and running totals in J1 and K1.
+TRIP_COLUMNS = 11
+
+# Static exchange rates, the same ones stored in the 'currency_exchange'
+# worksheet. They are used to populate a new SQLite database.
+DEFAULT_RATES = {
+    ("EUR", "GBP"): 1.1,
+    ("EUR", "USD"): 0.86,
+    ("EUR", "EUR"): 1.0,
+    ("GBP", "EUR"): 1.16,
+    ("GBP", "USD"): 1.27,
+    ("GBP", "GBP"): 1.0,
+    ("USD", "EUR"): 0.91,
+    ("USD", "GBP"): 0.78,
+    ("USD", "USD"): 1.0
+}
+
+
+def group_consecutive(numbers):
+    """
+    Group the numbers into blocks of consecutive numbers.
+    Return a sorted list of (first, last) tuples.
+    """
+    blocks = []
+    for number in sorted(set(numbers)):
+        if blocks and number == blocks[-1][1] + 1:
+            blocks[-1] = (blocks[-1][0], number)
+        else:
+            blocks.append((number, number))
+    return blocks
+
+
+def same_values(saved_row, row):
+    """
+    Return True if a row read from Google Sheets holds the values
+    of the row written. Numbers are compared by value, and may be
+    text with a decimal comma in rows saved by older versions.
+    """
+    if len(saved_row) < len(row):
+        return False
+    for saved_value, value in zip(saved_row, row):
+        if str(saved_value) == str(value):
+            continue
+        try:
+            if not math.isclose(
+                float(str(saved_value).replace(",", ".")), float(value)
+            ):
+                return False
+        except ValueError:
+            return False
+    return True
+
+
+def date_to_serial(date_str):
+    """
+    Return the serial number of a DATE_FORMAT date.
+    """
+    day = datetime.strptime(date_str, DATE_FORMAT).date()
+    return (day - SERIAL_EPOCH).days
+
+
+def serial_to_date(value):
+    """
+    Return a saved date as a DATE_FORMAT string. Dates are saved as
+    serial numbers, or as text in rows saved by older versions.
+    """
+    if isinstance(value, str):
+        return value
+    return (SERIAL_EPOCH + timedelta(days=int(value))).strftime(DATE_FORMAT)
+
+
+def to_cents(cost):
+    """
+    Return a cost as a whole number of cents. Costs are saved as
+    numbers, or as text in rows saved by older versions, which may
+    use a decimal comma. Those rows can have blank costs, counted as 0.
+    """
+    if isinstance(cost, str):
+        cost = cost.strip().replace(",", ".") or 0
+    return round(float(cost) * 100)
+
+
+def from_cents(cents):
+    """
+    Return the cost to save for a whole number of cents.
+    """
+    return cents / 100
+
+
+def get_sheet():
+    """
+    Return the 'trip_split' spreadsheet.
+    The connection to Google Sheets is opened the first time
+    it's needed and reused afterwards.
+    """
+    global SHEET
+    if SHEET is None:
+        import gspread
+        from google.oauth2.service_account import Credentials
+
+        creds = Credentials.from_service_account_file("creds.json")
+        scoped_creds = creds.with_scopes(SCOPE)
+        gspread_client = gspread.authorize(scoped_creds)
+        SHEET = SCHEDULER.read(gspread_client.open, "trip_split")
+    return SHEET
+
+
+class TokenBucket:
+    """
+    Token bucket spacing out requests to stay within a quota
+    per minute. It holds up to capacity tokens, refilled at the
+    quota rate, and every request takes one.
+    """
+    def __init__(self, per_minute, capacity):
+        """
+        Initialize a full bucket.
+        """
+        self.rate = per_minute / 60  # Tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        """
+        Take a token and return the number of seconds to wait before
+        using it. When the bucket is empty the token is taken ahead
+        of its refill, so that callers can wait without holding the
+        lock guarding the bucket, one after the other.
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+def retry_status(error):
+    """
+    Return the HTTP status of an error worth retrying: 429 when over
+    quota, 5xx for server errors and 0 for a lost connection.
+    Return None for any other error.
+    """
+    from gspread.exceptions import APIError
+    from requests.exceptions import ConnectionError, Timeout
+
+    if isinstance(error, APIError):
+        status = error.response.status_code
+        if status == 429 or status >= 500:
+            return status
+    elif isinstance(error, (ConnectionError, Timeout)):
+        return 0
+    return None
+
+
+class RequestScheduler:
+    """
+    Single point through which every Google Sheets request is sent.
+    Reads and writes each take a token from their own bucket, and
+    requests failing with a temporary error are retried with
+    exponential backoff and jitter.
+    A write that isn't safe to repeat passes an applied() function,
+    called before each retry: if the failed request was saved anyway
+    it returns a true value, which is returned instead of retrying.
+    """
+    def __init__(
+        self,
+        read_quota=SHEETS_READ_QUOTA,
+        write_quota=SHEETS_WRITE_QUOTA,
+        max_retries=SHEETS_MAX_RETRIES
+    ):
+        """
+        Initialize the buckets and counters. Buckets hold ten seconds
+        of quota so that short bursts aren't delayed.
+        """
+        self.buckets = {
+            "read": TokenBucket(read_quota, max(1, read_quota // 6)),
+            "write": TokenBucket(write_quota, max(1, write_quota // 6))
+        }
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = {
+            "requests": 0,
+            "throttled": 0,  # Delayed to stay within the quota
+            "retried": 0,
+            "over_quota": 0,  # Rejected with 429
+            "duplicates_avoided": 0,
+            "failed": 0  # Given up after max_retries
+        }
+
+    def disable_retries(self):
+        """
+        Stop retrying the requests of the current thread.
+        Used by background threads, which mustn't delay the exit.
+        """
+        self.local.max_retries = 0
+
+    def read(self, function, *args, **kwargs):
+        """
+        Call a function reading from Google Sheets.
+        """
+        return self.call("read", function, args, kwargs)
+
+    def write(self, function, *args, applied=None, **kwargs):
+        """
+        Call a function writing to Google Sheets.
+        """
+        return self.call("write", function, args, kwargs, applied)
+
+    def call(self, kind, function, args, kwargs, applied=None):
+        """
+        Call the function once a token is available, retrying it
+        on temporary errors. Return what the function returns.
+        """
+        max_retries = getattr(self.local, "max_retries", self.max_retries)
+        attempt = 0
+        while True:
+            with self.lock:
+                wait = self.buckets[kind].take()
+                if wait:
+                    self.counters["throttled"] += 1
+                self.counters["requests"] += 1
+            time.sleep(wait)  # Without the lock, so other threads go on
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                status = retry_status(error)
+                if status is None:
+                    raise
+                if attempt == max_retries:
+                    self.count("failed")
+                    raise
+            finally:
+                PROFILER.record_request(
+                    kind, function, start, time.perf_counter() - start
+                )
+            attempt += 1
+            self.count("retried")
+            if status == 429:
+                self.count("over_quota")
+            time.sleep(self.backoff(attempt))
+            if applied is not None and status != 429:
+                # A request rejected with 429 was never carried out.
+                # Any other error may have come after the write was saved.
+                result = applied()
+                if result:
+                    self.count("duplicates_avoided")
+                    return result
+
+    def count(self, counter):
+        """
+        Add one to a counter, holding the lock.
+        """
+        with self.lock:
+            self.counters[counter] += 1
+
+    def backoff(self, attempt):
+        """
+        Return the seconds to wait before a retry. The delay doubles
+        with each attempt, with random jitter so that clients retrying
+        at the same time spread out.
+        """
+        delay = min(
+            SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** (attempt - 1)
+        )
+        return random.uniform(delay / 2, delay)
+
+    def report(self):
+        """
+        Print the counters if any request was throttled or retried.
+        """
+        if self.counters["throttled"] or self.counters["retried"]:
+            print(
+                "Google Sheets requests: "
+                + ", ".join(
+                    f"{count} {name.replace('_', ' ')}"
+                    for name, count in self.counters.items()
+                )
+            )
+
+
+SCHEDULER = RequestScheduler()
+
+
+class Profiler:
+    """
+    Record every Google Sheets request with its latency, attributed
+    to the action (screen or step decorated with profiled) that made
+    it. Requests made outside any action are attributed to "startup",
+    or to the name of the background thread making them.
+    Trace events are only kept when tracing is enabled with --profile.
+    """
+    def __init__(self):
+        """
+        Initialize empty statistics, with tracing disabled.
+        """
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started_at = time.perf_counter()
+        self.actions = {}  # Action name: statistics, see action_stats()
+        self.events = None  # Trace events, a list when tracing
+
+    def enable_tracing(self):
+        """
+        Start keeping a trace event for each action and request.
+        """
+        self.events = []
+
+    def current_action(self):
+        """
+        Return the name of the innermost action of the current thread.
+        """
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            return stack[-1]
+        thread = threading.current_thread()
+        if thread is threading.main_thread():
+            return "startup"
+        return thread.name.rsplit("_", 1)[0]  # e.g. "prefetch_0"
+
+    def action_stats(self, action):
+        """
+        Return the statistics of the action, creating them if needed.
+        Must be called with the lock held.
+        """
+        if action not in self.actions:
+            self.actions[action] = {
+                "runs": 0,
+                "reads": 0,
+                "writes": 0,
+                "seconds": 0.0,  # Spent waiting for requests
+                "max_seconds": 0.0,
+                "histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+                "requests": {}  # Function name: number of requests
+            }
+        return self.actions[action]
+
+    def trace(self, name, category, start, seconds, **args):
+        """
+        Keep a complete trace event, if tracing.
+        Must be called with the lock held.
+        """
+        if self.events is not None:
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round((start - self.started_at) * 1e6),
+                "dur": round(seconds * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args
+            })
+
+    def record_request(self, kind, function, start, seconds):
+        """
+        Record a request to Google Sheets, retries included, sent
+        at the start perf_counter time and taking the given seconds.
+        """
+        action = self.current_action()
+        name = getattr(function, "__name__", type(function).__name__)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds * 1000)
+        with self.lock:
+            stats = self.action_stats(action)
+            stats["reads" if kind == "read" else "writes"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["histogram"][bucket] += 1
+            stats["requests"][name] = stats["requests"].get(name, 0) + 1
+            self.trace(name, "sheets", start, seconds, kind=kind,
+                       action=action)
+
+    def run(self, action, function, *args, **kwargs):
+        """
+        Call the function as the given action and return its result.
+        """
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(action)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack.pop()
+            with self.lock:
+                self.action_stats(action)["runs"] += 1
+                self.trace(
+                    action, "action", start, time.perf_counter() - start
+                )
+
+    def stats(self):
+        """
+        Return the statistics of every action and the scheduler
+        counters, as saved in the profile file.
+        """
+        with self.lock:
+            return {
+                "latency_buckets_ms": LATENCY_BUCKETS,
+                "actions": copy.deepcopy(self.actions),
+                "scheduler": dict(SCHEDULER.counters)
+            }
+
+    def print_stats(self):
+        """
+        Print the requests and latency of each action, and the
+        latency histogram of all the requests.
+        """
+        stats = self.stats()
+        actions = [
+            (name, action) for name, action in stats["actions"].items()
+            if action["reads"] or action["writes"]
+        ]
+        if not actions:
+            print("No Google Sheets requests have been made yet.\n")
+            return
+        rows = []
+        histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        for name, action in sorted(
+            actions, key=lambda item: item[1]["seconds"], reverse=True
+        ):
+            count = action["reads"] + action["writes"]
+            rows.append((
+                name,
+                action["runs"],
+                action["reads"],
+                action["writes"],
+                action["seconds"] * 1000,
+                action["seconds"] * 1000 / count,
+                action["max_seconds"] * 1000
+            ))
+            histogram = [
+                total + bucket
+                for total, bucket in zip(histogram, action["histogram"])
+            ]
+        print(
+            tabulate(
+                rows,
+                headers=[
+                    "Action", "Runs", "Reads", "Writes",
+                    "Sheets (ms)", "Mean (ms)", "Max (ms)"
+                ],
+                tablefmt="mixed_grid",
+                floatfmt=".1f"
+            )
+        )
+        print("")
+        labels = [f"< {bound} ms" for bound in LATENCY_BUCKETS]
+        labels.append(f">= {LATENCY_BUCKETS[-1]} ms")
+        widest = max(histogram)
+        print(
+            tabulate(
+                [
+                    (label, count, "#" * math.ceil(30 * count / widest))
+                    for label, count in zip(labels, histogram)
+                ],
+                headers=["Latency", "Requests", ""],
+                tablefmt="mixed_grid"
+            )
+        )
+
+    def write(self, path):
+        """
+        Write the trace events and the statistics to a JSON file
+        in the trace event format.
+        """
+        with self.lock:
+            events = list(self.events or [])
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "traceEvents": events,
+                    "displayTimeUnit": "ms",
+                    "stats": self.stats()
+                },
+                file,
+                indent=1
+            )
+        print(f"Profile written to {path}")
+
+
+PROFILER = Profiler()
+
+
+def profiled(function):
+    """
+    Decorator attributing the Google Sheets requests made by the
+    function to it, as an action of the profile.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return PROFILER.run(function.__name__, function, *args, **kwargs)
+    return wrapper
+
+
+def startup_profile(storage="sheets", database=SQLITE_PATH):
+    """
+    Print how long it takes to import each of the modules loaded
+    on demand and to open the storage: the connection to Google Sheets
+    or the SQLite database, depending on the storage chosen.
+    """
+    modules = LAZY_MODULES
+    if storage == "sheets":
+        modules = SHEETS_MODULES + LAZY_MODULES
+    timings = []
+    for module in modules:
+        start = time.perf_counter()
+        importlib.import_module(module)
+        timings.append((f"import {module}", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    if storage == "sqlite":
+        SQLiteStorage(database)
+        step = "open the SQLite database"
+    else:
+        get_sheet()
+        step = "connect to Google Sheets"
+    timings.append((step, time.perf_counter() - start))
+
+    total = sum(seconds for step, seconds in timings)
+    timings.append(("Total", total))
+    print(
+        tabulate(
+            [(step, f"{seconds * 1000:.1f}") for step, seconds in timings],
+            headers=["Step", "Time (ms)"],
+            tablefmt="mixed_grid"
+        )
+    )
+
 
 def clear_terminal():
     """
@@ -39,14 +706,17 @@ def clear_terminal():
     os.system("cls" if os.name == "nt" else "clear")
 
 
+@profiled
 def welcome_menu():
     """
-    Print welcome message and ask to choose between create trip and see list.
-    Check the option chosen in valid and call the corresponding function.
+    Print welcome message and ask to choose between create trip, see list,
+    refresh the exchange rates, see the overview of all trips, see
+    the Google Sheets requests of the session and see the archived trips.
+    Check the option chosen in valid and return the corresponding screen.
     Run a while loop asking for input until it's a valid option.
     If it's a new trip run a while loop until the name of the trip is new.
     """
-    worksheets = SHEET.worksheets()
+    import pyfiglet
 
     welcome_message = pyfiglet.figlet_format(
         "Welcome to\n\tTrip Split"
@@ -56,20 +726,32 @@ def welcome_menu():
     print(" * Add, edit, or delete trips and their costs.")
     print(" * Gain insights into individual expenditures.\n")
     print("What would you like to do?\n")
-    print(tabulate([[1, "Create new trip"], [2, "See existing trips"]]))
+    print(
+        tabulate(
+            [
+                [1, "Create new trip"],
+                [2, "See existing trips"],
+                [3, "Refresh exchange rates"],
+                [4, "Overview of all trips"],
+                [5, "Session statistics"],
+                [6, "Archived trips"]
+            ]
+        )
+    )
     print("")
 
     while True:
-        trips = [trip.title for trip in worksheets]
-        user_choice = input("Please, enter your prefered option (1 or 2):\n")
-        validated_choice = validate_user_choice(user_choice, range(1, 3))
+        user_choice = input(
+            "Please, enter your prefered option (1, 2, 3, 4, 5 or 6):\n"
+        )
+        validated_choice = validate_user_choice(user_choice, range(1, 7))
         validated_choice_bool, validated_choice_num = validated_choice
         if validated_choice_bool:
             clear_terminal()
             if validated_choice_num == 1:
                 while True:
                     trip_name = input("Enter the name of the trip\n")
-                    if trip_name in trips:
+                    if STORAGE.trip_exists(trip_name):
                         clear_terminal()
                         print(
                             Fore.RED +
@@ -78,9 +760,49 @@ def welcome_menu():
                         print("Please select a different name.\n")
                     else:
                         print("Creating new trip...\n")
-                        create_new_trip(trip_name)
+                        return (create_new_trip, trip_name)
             elif validated_choice_num == 2:
-                load_trips()
+                return (load_trips,)
+            elif validated_choice_num == 3:
+                EXCHANGE_RATES.refresh()
+                print(
+                    Fore.YELLOW +
+                    f"{EXCHANGE_RATES.count()} exchange rates loaded.\n"
+                )
+            elif validated_choice_num == 4:
+                return (see_dashboard,)
+            elif validated_choice_num == 5:
+                return (see_stats,)
+            elif validated_choice_num == 6:
+                return (see_archives,)
+
+
+class Navigate(Exception):
+    """
+    Raised from inside a prompt to leave the current screen.
+    The arguments are the next screen function followed by its arguments,
+    the same tuple that screen functions return.
+    """
+
+
+def run_screens(*screen):
+    """
+    Run the menus as a loop instead of having screens call each other.
+    Each screen function returns the next screen as a tuple with the
+    function and its arguments, so the call stack never grows.
+    The loop ends when a screen returns None.
+    """
+    while screen is not None:
+        screen_function, *args = screen
+        try:
+            screen = screen_function(*args)
+        except Navigate as navigate:
+            screen = navigate.args
+        except TripChanged as e:
+            print(Fore.RED + f"{e}")
+            time.sleep(2)
+            clear_terminal()
+            screen = (select_trip, e.args[0])
 
 
 def validate_user_choice(data, choices):
@@ -104,29 +826,25 @@ def validate_user_choice(data, choices):
     return (True, new_number)
 
 
+@profiled
 def create_new_trip(name):
     """
-    Create a new worksheet for the trip with the name provided by the user.
-    The worksheet is populated with the column headers.
+    Create a new trip with the name provided by the user.
+    The storage backend saves it with the column headers and currency.
     A loop asks the user to provide expenses, calling the appropiate function.
     """
     print("Please select your base currency.")
     print("All your expenses will be converted to this currency")
     print("and will be used to show the summary of your trip.\n")
-    chosen_currency = get_currency(name)
-
-    SHEET.add_worksheet(title=name, rows=100, cols=20)
-    worksheet = SHEET.worksheet(name)
-    header = [
-        "Date",
-        "Name",
-        "Concept",
-        "Cost",
-        "Currency",
-        "Cost_chosen_currency",
-        "Chosen_currency"]
-    worksheet.append_row(header)
-    worksheet.update("J1", [[chosen_currency]])
+    try:
+        chosen_currency = get_currency(name)
+    except Navigate:
+        print("The trip creation process has been aborted.")
+        time.sleep(1.5)
+        clear_terminal()
+        return (welcome_menu,)
+
+    STORAGE.create_trip(name, chosen_currency)
 
     print(Fore.YELLOW + f"{name} successfully created!")
     time.sleep(1.5)
@@ -147,19 +865,18 @@ def create_new_trip(name):
         else:
             if add_expense.lower() == "n":
                 clear_terminal()
-                select_trip(name)
+                return (select_trip, name)
             elif add_expense.lower() == "y":
                 create_expense(name)
 
 
+@profiled
 def create_expense(trip_name):
     """
     Call all functions to get expense data from user.
     Create an instance from expense class and call write_new_expense
     function passing the expense.
     """
-    worksheet = trip_name
-
     clear_terminal()
     date = get_date(trip_name)
     name = get_name(trip_name)
@@ -169,7 +886,58 @@ def create_expense(trip_name):
 
     expense = Expense(trip_name, date, name, concept, cost, currency)
 
-    check_expense(write_new_expense, worksheet, expense, row_edit=0)
+    check_expense(write_new_expense, trip_name, expense, entry_ind=None)
+
+
+def validate_date(date):
+    """
+    Check that the date is a valid dd/mm/yyyy date.
+    Return it formatted as str or raise ValueError.
+    """
+    date_obj = datetime.strptime(date.strip(), DATE_FORMAT)
+    return date_obj.strftime(DATE_FORMAT)
+
+
+def validate_name(name):
+    """
+    Check that the name of the person isn't empty.
+    Return it capitalized or raise ValueError.
+    """
+    if not name.strip():
+        raise ValueError("The name is empty.")
+    return name.strip().title()
+
+
+def validate_concept(concept):
+    """
+    Check that the concept is one of the CONCEPTS, given by name or code.
+    Return the concept name or raise ValueError.
+    """
+    for code, name in CONCEPTS.items():
+        if concept.strip().lower() in [str(code), name.lower()]:
+            return name
+    raise ValueError(f"{concept} is not a valid concept.")
+
+
+def validate_cost(cost):
+    """
+    Check that the cost is a finite number.
+    Return it as a float or raise ValueError.
+    """
+    cost_float = float(cost)
+    if not math.isfinite(cost_float):
+        raise ValueError(f"{cost} is not a valid cost.")
+    return cost_float
+
+
+def validate_currency(currency):
+    """
+    Check that the currency is an ISO 4217 code with exchange rates.
+    Return the currency code or raise ValueError.
+    """
+    if currency.strip().upper() not in EXCHANGE_RATES.currencies():
+        raise ValueError(f"{currency} is not a valid currency.")
+    return currency.strip().upper()
 
 
 def get_date(trip_name):
@@ -178,19 +946,17 @@ def get_date(trip_name):
     Give the possibility to cancel the process.
     If the data entered is invalid ask again.
     """
-    date_format = "%d/%m/%Y"
-
     while True:
         try:
             print("Enter date in the following format dd/mm/yyyy")
             date = input("Example: 30/06/2023 or enter C to cancel:\n")
             if date.lower() == "c":
                 clear_terminal()
-                select_trip(trip_name)
+                raise Navigate(select_trip, trip_name)
             else:
-                date_obj = datetime.strptime(date, date_format)
+                date_str = validate_date(date)
                 clear_terminal()
-                return date_obj.strftime("%d/%m/%Y")
+                return date_str
         except ValueError:
             print(
                 Fore.RED + "The date entered is not valid, please try again.\n"
@@ -206,10 +972,11 @@ def get_name(trip_name):
     while True:
         try:
             print("Enter the name of the person who paid.")
-            name = input("Example: John or enter C to cancel:\n").title()
+            name = input("Example: John or enter C to cancel:\n")
             if name.lower() == "c":
                 clear_terminal()
-                select_trip(trip_name)
+                raise Navigate(select_trip, trip_name)
+            name = validate_name(name)
             clear_terminal()
             return name
         except ValueError:
@@ -224,14 +991,7 @@ def get_concept(trip_name):
     Give the possibility to cancel the process.
     If the data entered is invalid ask again.
     """
-    concepts = {
-        1: "Travel",
-        2: "Meals",
-        3: "Accomodation",
-        4: "Supermarket",
-        5: "Shopping",
-        6: "Other"
-    }
+    concepts = CONCEPTS
     concepts_headers = ["Code", "Concept"]
 
     print(
@@ -252,7 +1012,7 @@ def get_concept(trip_name):
         validated_choice_bool, validated_choice_num = validated_choice
         if user_choice.lower() == "c":
             clear_terminal()
-            select_trip(trip_name)
+            raise Navigate(select_trip, trip_name)
         elif validated_choice_bool:
             clear_terminal()
             return concepts[validated_choice_num]
@@ -270,8 +1030,8 @@ def get_cost(trip_name):
             cost = input("Example: 19.95 or press C to cancel:\n")
             if cost.lower() == "c":
                 clear_terminal()
-                select_trip(trip_name)
-            cost_float = float(cost)
+                raise Navigate(select_trip, trip_name)
+            cost_float = validate_cost(cost)
             clear_terminal()
             return cost_float
         except ValueError:
@@ -283,184 +1043,2609 @@ def get_currency(trip_name):
     Get currency input from the user from the list of options.
     Give the possibility to cancel the process.
     If the data entered is invalid ask again.
+    The currencies are shown a page at a time, the CURRENCIES first.
+    The user can enter a number of the page, a currency code,
+    or part of a code to search for it.
     """
-    currencies = {
-        1: "EUR",
-        2: "GBP",
-        3: "USD"
-    }
-    currencies_headers = ["Code", "Currency"]
-
-    print("Select one of the following code options:\n")
-    print(
-        tabulate(
-            [(str(code), currency) for code, currency in currencies.items()],
-            headers=currencies_headers,
-            tablefmt="mixed_grid"
-        )
+    currencies = list(CURRENCIES.values()) + sorted(
+        set(EXCHANGE_RATES.currencies()) - set(CURRENCIES.values())
     )
+    currencies_headers = ["Code", "Currency"]
+    matches = currencies
+    page = 0
 
     while True:
-        print("")
-        user_choice = input("Enter 1, 2, 3, or C to cancel:\n")
-        validated_choice = validate_user_choice(user_choice, range(1, 4))
-        validated_choice_bool, validated_choice_num = validated_choice
-        try:
-            if user_choice.lower() == "c":
-                clear_terminal()
-                select_trip(trip_name)
-            elif validated_choice_bool:
-                clear_terminal()
-                return currencies[validated_choice_num]
-        except gspread.exceptions.WorksheetNotFound:
-            print("The trip creation process has been aborted.")
-            time.sleep(1.5)
+        page_currencies = matches[
+            page * CURRENCY_PAGE_SIZE:(page + 1) * CURRENCY_PAGE_SIZE
+        ]
+        pages = math.ceil(len(matches) / CURRENCY_PAGE_SIZE)
+        print("Select one of the following code options:\n")
+        print(
+            tabulate(
+                [
+                    (str(code), currency)
+                    for code, currency in enumerate(page_currencies, start=1)
+                ],
+                headers=currencies_headers,
+                tablefmt="mixed_grid"
+            )
+        )
+        print(f"Page {page + 1} of {pages}. Enter N or P to change the page,")
+        print("or type a currency code, or part of it, to search.")
+        user_choice = input("Enter your selection or C to cancel:\n").strip()
+        if user_choice.lower() == "c":
             clear_terminal()
-            welcome_menu()
+            raise Navigate(select_trip, trip_name)
+        clear_terminal()
+        if user_choice.lower() in ["n", "p"]:
+            new_page = page + (1 if user_choice.lower() == "n" else -1)
+            if 0 <= new_page < pages:
+                page = new_page
+            else:
+                print(Fore.RED + "There are no more pages.\n")
+        elif user_choice.isdigit():
+            if 1 <= int(user_choice) <= len(page_currencies):
+                return page_currencies[int(user_choice) - 1]
+            print(Fore.RED + f"{user_choice} is not one of the options.\n")
+        elif user_choice.upper() in currencies:
+            return user_choice.upper()
+        else:
+            found = [
+                currency for currency in currencies
+                if user_choice.upper() in currency
+            ]
+            if found:
+                matches = found
+                page = 0
+            else:
+                print(Fore.RED + f"No currency matches {user_choice}.\n")
 
 
-class Expense:
+class TripRegistry:
     """
-    Expense class.
-    Contains all necessary attributes that a user must provide.
-    Chosen currency and exchange rate are returned trhough the methods.
+    Session registry of the spreadsheet worksheets.
+    Each worksheet handle and trip base currency is requested once
+    from Google Sheets and reused for the rest of the session.
+    The prefetch threads use it too, so a lock guards the handles.
     """
-    def __init__(self, trip_name, date, name, concept, cost, currency):
+    def __init__(self):
         """
-        Initialize the Expense object.
+        Initialize an empty registry. Worksheets are listed on first use.
         """
-        self.trip_name = trip_name
-        self.date = date
-        self.name = name
-        self.concept = concept
-        self.cost = cost
+        self.worksheets = None
+        self.currencies = {}
+        self.lock = threading.RLock()
+
+    def load(self):
+        """
+        List the worksheets of the spreadsheet and keep their handles.
+        """
+        with self.lock:
+            self.worksheets = {
+                worksheet.title: worksheet
+                for worksheet in SCHEDULER.read(get_sheet().worksheets)
+            }
+
+    def titles(self):
+        """
+        Return the titles of all worksheets, in spreadsheet order.
+        """
+        with self.lock:
+            if self.worksheets is None:
+                self.load()
+            return list(self.worksheets)
+
+    def trips(self):
+        """
+        Return the titles of the trip worksheets.
+        The first worksheet is 'currency_exchange', which isn't a trip.
+        """
+        return self.titles()[1:]
+
+    def worksheet(self, title):
+        """
+        Return the handle of the worksheet with the given title.
+        Raise gspread.exceptions.WorksheetNotFound if it doesn't exist.
+        """
+        with self.lock:
+            if self.worksheets is None:
+                self.load()
+            if title not in self.worksheets:
+                self.worksheets[title] = SCHEDULER.read(
+                    get_sheet().worksheet, title
+                )
+            return self.worksheets[title]
+
+    def chosen_currency(self, title):
+        """
+        Return the base currency of the trip.
+        """
+        if title not in self.currencies:
+            self.currencies[title] = SCHEDULER.read(
+                self.worksheet(title).acell, "J1"
+            ).value  # J1 is the cell storing the value in crate_new_trip()
+        return self.currencies[title]
+
+    def add(self, worksheet, chosen_currency):
+        """
+        Register a worksheet created during the session.
+        """
+        with self.lock:
+            if self.worksheets is None:
+                self.load()
+            self.worksheets[worksheet.title] = worksheet
+            self.currencies[worksheet.title] = chosen_currency
+
+    def remove(self, title):
+        """
+        Forget a worksheet deleted during the session.
+        """
+        with self.lock:
+            if self.worksheets is not None:
+                self.worksheets.pop(title, None)
+            self.currencies.pop(title, None)
+
+
+class TripNotFound(KeyError):
+    """
+    Raised when the storage backend has no trip with the given name.
+    """
+    def __str__(self):
+        return f"The {self.args[0]} trip doesn't exist."
+
+
+class TripChanged(Exception):
+    """
+    Raised when the entries of a trip have been changed by someone
+    else since they were read, before a write that addresses them
+    by row number.
+    """
+    def __str__(self):
+        return (
+            f"The {self.args[0]} trip has been changed by someone else. "
+            "Your change wasn't saved, please try again."
+        )
+
+
+class Storage:
+    """
+    Interface that every storage backend implements.
+    Trips are identified by their name and expenses by their index
+    within the trip, starting at 0 for the first entry.
+    Backends read over the network set remote, so that trips and
+    exchange rates are read ahead of time in background threads.
+    Expense rows follow the HEADER column order. Their values are
+    typed: the date is a serial number (see SERIAL_EPOCH), the costs
+    are numbers with whole cents and the rest are strings.
+    """
+    remote = False
+
+    def trips(self):
+        """
+        Return the names of all trips, in creation order.
+        """
+        raise NotImplementedError
+
+    def trip_exists(self, name):
+        """
+        Return True if the name is already used by a trip.
+        """
+        raise NotImplementedError
+
+    def create_trip(self, name, chosen_currency):
+        """
+        Create an empty trip with the given base currency.
+        """
+        raise NotImplementedError
+
+    def delete_trip(self, name):
+        """
+        Delete the trip and all its expenses.
+        """
+        raise NotImplementedError
+
+    def chosen_currency(self, name):
+        """
+        Return the base currency of the trip.
+        """
+        raise NotImplementedError
+
+    def get_trip_values(self, name):
+        """
+        Return the header followed by every expense row of the trip.
+        """
+        raise NotImplementedError
+
+    def get_expense(self, name, entry_ind):
+        """
+        Return the values of one expense row.
+        """
+        raise NotImplementedError
+
+    def entry_count(self, name):
+        """
+        Return the number of expense rows of the trip.
+        Backends override it to count them without reading them.
+        """
+        return len(self.get_trip_values(name)) - 1
+
+    def append_expense(self, name, row):
+        """
+        Add an expense row at the end of the trip.
+        """
+        raise NotImplementedError
+
+    def update_expense(self, name, entry_ind, row, old_row=None):
+        """
+        Overwrite an existing expense row. old_row is the row being
+        overwritten, if the caller has read it already, so that it
+        isn't read again.
+        """
+        raise NotImplementedError
+
+    def append_expenses(self, name, rows):
+        """
+        Add several expense rows at the end of the trip.
+        Backends override it to save them in a single request.
+        """
+        for row in rows:
+            self.append_expense(name, row)
+
+    def update_expenses(self, name, rows):
+        """
+        Overwrite several expense rows, given as a dictionary
+        of rows keyed by entry index.
+        Backends override it to save them in a single request.
+        """
+        for entry_ind, row in rows.items():
+            self.update_expense(name, entry_ind, row)
+
+    def delete_expense(self, name, entry_ind):
+        """
+        Delete an expense row. The following entries move up by one.
+        """
+        raise NotImplementedError
+
+    def delete_expenses(self, name, entry_inds):
+        """
+        Delete several expense rows, given by their index before
+        any of them is deleted.
+        Backends override it to delete them in a single request.
+        """
+        for entry_ind in sorted(set(entry_inds), reverse=True):
+            self.delete_expense(name, entry_ind)
+
+    def exchange_rates(self):
+        """
+        Return the history of exchange rates as a dictionary keyed by
+        (currency_base, currency_other). Each value is a list of
+        (effective_date, rate) tuples, where the date is None for
+        a rate in effect since before any dated rate.
+        """
+        raise NotImplementedError
+
+    def get_totals(self, name):
+        """
+        Return the running totals saved with the trip,
+        or None if they have never been saved.
+        """
+        raise NotImplementedError
+
+    def get_all_trips_values(self):
+        """
+        Return a dictionary with the base currency and the values
+        (as returned by get_trip_values) of every trip, keyed by name.
+        Backends override it to read all trips at once.
+        """
+        return {
+            name: (self.chosen_currency(name), self.get_trip_values(name))
+            for name in self.trips()
+        }
+
+    def save_totals(self, name, totals):
+        """
+        Save the running totals of the trip.
+        """
+        raise NotImplementedError
+
+    def rebase_trip(self, name, chosen_currency, converted, totals):
+        """
+        Save a new base currency for the trip together with the
+        converted cost of every expense, given as [cost, currency]
+        rows in entry order, and the new running totals.
+        """
+        raise NotImplementedError
+
+    def prefetch(self, names):
+        """
+        Read the values and totals of the trips ahead of time,
+        so that opening one of them doesn't wait for the storage.
+        Called from a background thread. Backends with slow reads
+        override it.
+        """
+
+    def compact(self, names):
+        """
+        Free the space the trips don't use in the storage.
+        Return a dictionary with the number of cells freed,
+        keyed by the name of the trips that were compacted.
+        Backends that allocate space ahead of time override it.
+        """
+        return {}
+
+    def pending_count(self, name=None):
+        """
+        Return the number of expense rows not saved yet,
+        for one trip or for all trips if no name is given.
+        """
+        return 0
+
+    def flush(self, name=None):
+        """
+        Save the pending expense rows of one trip, or of all trips
+        if no name is given.
+        """
+
+    def write_id(self, name):
+        """
+        Return the id of the last write made to the trip, to be passed
+        to is_saved() later. Backends that save each write before
+        returning have no ids.
+        """
+        return None
+
+    def is_saved(self, name, write_id):
+        """
+        Return True if the write of the trip with the given id,
+        and every write before it, has been saved.
+        """
+        return True
+
+
+def column_format(sheet_id, first_column, last_column, kind, pattern):
+    """
+    Return a batch_update request setting the number format of the
+    columns from first_column to last_column (excluded).
+    The header is text, so the format only changes how the values
+    below it are shown. Rows added to the grid when expenses are
+    appended take the format of the row above.
+    """
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startColumnIndex": first_column,
+                "endColumnIndex": last_column
+            },
+            "cell": {
+                "userEnteredFormat": {
+                    "numberFormat": {"type": kind, "pattern": pattern}
+                }
+            },
+            "fields": "userEnteredFormat.numberFormat"
+        }
+    }
+
+
+def trip_formats(sheet_id):
+    """
+    Return the batch_update requests formatting a trip worksheet:
+    dates are shown as dates, costs with two decimals and the header
+    row is frozen. The frozen header tells the trips formatted apart
+    from the ones created by older versions.
+    """
+    return [
+        column_format(sheet_id, 0, 1, "DATE", "dd/mm/yyyy"),
+        column_format(sheet_id, 3, 6, "NUMBER", "0.00"),
+        {
+            "updateSheetProperties": {
+                "properties": {
+                    "sheetId": sheet_id,
+                    "gridProperties": {"frozenRowCount": 1}
+                },
+                "fields": "gridProperties.frozenRowCount"
+            }
+        }
+    ]
+
+
+class SheetsStorage(Storage):
+    """
+    Storage backend saving each trip in its own worksheet
+    of the 'trip_split' Google Spreadsheet.
+    The values and totals of each trip read during the session are kept
+    in a local snapshot, which the session's own writes update in place.
+    Snapshots are dropped only when the spreadsheet modified time shows
+    that it has changed. The modified time is checked at most once every
+    SNAPSHOT_CHECK_INTERVAL seconds for reads, and always before a write
+    addressing entries by row number. A change following writes of this
+    session may be theirs or someone else's: the snapshots of the trips
+    written are kept but unverified, until the next row-number write
+    compares them with the worksheet, and the others are dropped.
+    """
+    remote = True
+
+    def __init__(self, check_interval=SNAPSHOT_CHECK_INTERVAL):
+        """
+        Initialize the backend with an empty worksheet registry
+        and no snapshots.
+        """
+        self.registry = TripRegistry()
+        self.snapshots = {}  # Trip name: {"values": rows, "totals": dict}
+        self.check_interval = check_interval
+        self.checked_at = None
+        self.modified_time = None
+        self.own_writes = set()  # Trips written since the last check
+        self.formatted = set()  # Trips formatted during the session
+        self.unverified = set()  # Trips written before a change was seen
+        # Snapshots are also filled by the prefetch thread. The lock
+        # guards them, and the generation counts the changes made to
+        # them so that data read before a change isn't stored after it.
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def worksheet(self, name):
+        """
+        Return the worksheet of the trip.
+        Raise TripNotFound if there isn't one.
+        """
+        from gspread.exceptions import WorksheetNotFound
+
+        try:
+            return self.registry.worksheet(name)
+        except WorksheetNotFound:
+            raise TripNotFound(name) from None
+
+    def check_snapshots(self, force=False):
+        """
+        Drop the snapshots if the spreadsheet has been modified since
+        the last check, keeping the ones of the trips this session has
+        written since as unverified.
+        Unless forced, it's checked at most once every check_interval.
+        """
+        now = time.monotonic()
+        if (
+            not force
+            and self.checked_at is not None
+            and now - self.checked_at < self.check_interval
+        ):
+            return
+        sheet = get_sheet()
+        SCHEDULER.read(sheet.refresh_lastUpdateTime)
+        modified_time = sheet.lastUpdateTime
+        if (
+            self.modified_time is not None
+            and modified_time != self.modified_time
+        ):
+            with self.lock:
+                if not self.own_writes:
+                    self.registry = TripRegistry()
+                self.snapshots = {
+                    name: snapshot
+                    for name, snapshot in self.snapshots.items()
+                    if name in self.own_writes
+                }
+                self.unverified = (
+                    self.unverified | self.own_writes
+                ) & set(self.snapshots)
+                self.generation += 1
+        with self.lock:
+            self.own_writes = set()
+        self.modified_time = modified_time
+        self.checked_at = now
+
+    def own_write(self, *names):
+        """
+        Record the trips changed by a write of this session, so that
+        the next check doesn't drop their snapshots for it.
+        """
+        with self.lock:
+            self.own_writes.update(names)
+
+    def check_rows(self, name):
+        """
+        Make sure the entries of the trip are the ones this session
+        has read before writing to them by row number, checking the
+        modified time regardless of the interval. Snapshots not
+        verified since a write are compared with the worksheet.
+        Raise TripChanged if the entries have changed.
+        """
+        values = self.snapshots.get(name, {}).get("values")
+        self.check_snapshots(force=True)
+        if values is None:
+            return  # Rows read directly from the worksheet
+        if (
+            name not in self.unverified
+            and self.snapshots.get(name, {}).get("values") is values
+        ):
+            return
+        with self.lock:
+            self.snapshots.get(name, {}).pop("values", None)
+            self.unverified.discard(name)
+            self.generation += 1
+        saved = self.get_trip_values(name)
+        if len(saved) != len(values) or not all(
+            same_values(saved_row, row)
+            for saved_row, row in zip(saved, values)
+        ):
+            raise TripChanged(name)
+
+    def snapshot(self, name, key):
+        """
+        Return the snapshot values or totals of the trip,
+        or None if they haven't been read yet.
+        """
+        self.check_snapshots()
+        return self.snapshots.get(name, {}).get(key)
+
+    def written(self, name, key, value):
+        """
+        Record a write made by this session and keep the snapshot up to date.
+        """
+        with self.lock:
+            self.generation += 1
+            self.snapshots.setdefault(name, {})[key] = value
+        self.own_write(name)
+
+    def trips(self):
+        self.check_snapshots()
+        return self.registry.trips()
+
+    def trip_exists(self, name):
+        self.check_snapshots()
+        return name in self.registry.titles()
+
+    def create_trip(self, name, chosen_currency):
+        sheet = get_sheet()
+        worksheet = SCHEDULER.write(
+            sheet.add_worksheet,
+            title=name,
+            rows=1,
+            cols=TRIP_COLUMNS,
+            applied=lambda: self.find_worksheet(name)
+        )
+        header = HEADER + [
+            "", "", chosen_currency, json.dumps(empty_totals())
+        ]  # J1 stores the currency and K1 the running totals
+        SCHEDULER.write(sheet.batch_update, {"requests": [
+            {
+                "updateCells": {
+                    "start": {"sheetId": worksheet.id},
+                    "rows": [{"values": [
+                        {"userEnteredValue": {"stringValue": value}}
+                        for value in header
+                    ]}],
+                    "fields": "userEnteredValue"
+                }
+            }
+        ] + trip_formats(worksheet.id)})
+        self.formatted.add(name)
+        self.registry.add(worksheet, chosen_currency)
+        with self.lock:
+            self.generation += 1
+            self.snapshots[name] = {
+                "values": [list(HEADER)], "totals": empty_totals()
+            }
+        self.own_write(name)
+
+    def delete_trip(self, name):
+        SCHEDULER.write(
+            get_sheet().del_worksheet,
+            self.worksheet(name),
+            applied=lambda: self.find_worksheet(name) is None
+        )
+        with self.lock:
+            self.registry.remove(name)
+            self.snapshots.pop(name, None)
+            self.generation += 1
+        self.own_write(name)
+
+    def chosen_currency(self, name):
+        self.worksheet(name)
+        if name not in self.registry.currencies:
+            # J1:K1 holds the currency and the running totals, which
+            # are needed next, so both are read with one request
+            self.get_totals(name)
+        return self.registry.chosen_currency(name)
+
+    def get_trip_values(self, name):
+        values = self.snapshot(name, "values")
+        if values is None:
+            data = SCHEDULER.read(
+                self.worksheet(name).get_all_values, **RENDER_OPTIONS
+            )
+            values = [row[:len(HEADER)] for row in data]
+            with self.lock:
+                self.snapshots.setdefault(name, {})["values"] = values
+        return [list(row) for row in values]
+
+    def get_expense(self, name, entry_ind):
+        values = self.snapshot(name, "values")
+        if values is not None:
+            return list(values[entry_ind + 1])
+        row_number = (
+            entry_ind + 2
+        )  # +2 because worksheet starts at 1 and the first line is the header
+        return SCHEDULER.read(
+            self.worksheet(name).row_values, row_number, **RENDER_OPTIONS
+        )
+
+    def entry_count(self, name):
+        values = self.snapshot(name, "values")
+        if values is not None:
+            return len(values) - 1
+        totals = self.get_totals(name)  # Read with the currency in J1:K1
+        if totals is not None:
+            return totals["count"]
+        return len(self.get_trip_values(name)) - 1
+
+    def format_trip(self, name):
+        """
+        Format the worksheet of a trip created by an older version
+        the first time rows are written to it, so that the serial
+        number dates written are shown as dates.
+        """
+        worksheet = self.worksheet(name)
+        if name in self.formatted or worksheet.frozen_row_count:
+            return
+        SCHEDULER.write(
+            get_sheet().batch_update, {"requests": trip_formats(worksheet.id)}
+        )
+        self.formatted.add(name)
+        self.own_write(name)
+
+    def append_expense(self, name, row):
+        self.append_expenses(name, [row])
+
+    def update_expense(self, name, entry_ind, row, old_row=None):
+        self.check_rows(name)
+        self.format_trip(name)
+        row_number = entry_ind + 2
+        SCHEDULER.write(
+            self.worksheet(name).update,
+            f"A{row_number}:G{row_number}",
+            [row],
+            value_input_option="RAW"
+        )
+        self.update_snapshot(name, updates={entry_ind: row})
+
+    def append_expenses(self, name, rows):
+        self.format_trip(name)
+        values = self.snapshot(name, "values")
+        row_count = (
+            len(values) + len(rows) if values is not None else None
+        )  # Without a snapshot only the last rows can be compared
+        SCHEDULER.write(
+            self.worksheet(name).append_rows,
+            rows,
+            value_input_option="RAW",
+            table_range="A:G",  # Avoids appending in the wrong place
+            applied=lambda: self.rows_saved(name, row_count, rows)
+        )
+        self.update_snapshot(name, appends=rows)
+
+    def update_expenses(self, name, rows):
+        self.check_rows(name)
+        self.format_trip(name)
+        SCHEDULER.write(
+            self.worksheet(name).batch_update,
+            [
+                {
+                    "range": f"A{entry_ind + 2}:G{entry_ind + 2}",
+                    "values": [row]
+                }
+                for entry_ind, row in rows.items()
+            ],
+            value_input_option="RAW"
+        )
+        self.update_snapshot(name, updates=rows)
+
+    def delete_expense(self, name, entry_ind):
+        self.check_rows(name)
+        row_count = len(self.get_trip_values(name)) - 1
+        SCHEDULER.write(
+            self.worksheet(name).delete_rows,
+            entry_ind + 2,
+            applied=lambda: self.rows_saved(name, row_count)
+        )
+        self.update_snapshot(name, deletes=[entry_ind])
+
+    def delete_expenses(self, name, entry_inds):
+        self.check_rows(name)
+        worksheet = self.worksheet(name)
+        requests = []
+        # Consecutive entries are deleted together. Blocks are deleted
+        # from the bottom up so that the rows above don't move.
+        for first, last in reversed(group_consecutive(entry_inds)):
+            requests.append({
+                "deleteDimension": {
+                    "range": {
+                        "sheetId": worksheet.id,
+                        "dimension": "ROWS",
+                        "startIndex": first + 1,  # +1 for the header
+                        "endIndex": last + 2
+                    }
+                }
+            })
+        row_count = len(self.get_trip_values(name)) - len(set(entry_inds))
+        SCHEDULER.write(
+            get_sheet().batch_update,
+            {"requests": requests},
+            applied=lambda: self.rows_saved(name, row_count)
+        )
+        self.update_snapshot(name, deletes=entry_inds)
+
+    def find_worksheet(self, name):
+        """
+        Return the worksheet of the trip, listing the worksheets again
+        instead of using the registry, or None if there isn't one.
+        """
+        for worksheet in SCHEDULER.read(get_sheet().worksheets):
+            if worksheet.title == name:
+                return worksheet
+        return None
+
+    def rows_saved(self, name, row_count, rows=()):
+        """
+        Return True if the worksheet of the trip has row_count rows,
+        header included, and ends with the given rows.
+        Used to find out if a failed write was saved anyway.
+        The number of rows isn't checked if row_count is None.
+        """
+        data = SCHEDULER.read(
+            self.worksheet(name).get_all_values, **RENDER_OPTIONS
+        )
+        if row_count is not None and len(data) != row_count:
+            return False
+        if len(data) - 1 < len(rows):
+            return False
+        saved = data[len(data) - len(rows):]
+        return all(
+            same_values(saved_row, row) for saved_row, row in zip(saved, rows)
+        )
+
+    def update_snapshot(self, name, appends=(), updates=None, deletes=()):
+        """
+        Apply the rows written by this session to the snapshot values.
+        """
+        with self.lock:
+            self.generation += 1
+            values = self.snapshots.get(name, {}).get("values")
+            if values is not None:
+                for entry_ind, row in (updates or {}).items():
+                    values[entry_ind + 1] = list(row)
+                for row in appends:
+                    values.append(list(row))
+                for entry_ind in sorted(set(deletes), reverse=True):
+                    del values[entry_ind + 1]
+        self.own_write(name)
+
+    def read_trips(self, names):
+        """
+        Read the worksheets of the trips, BATCH_GET_RANGES of them
+        per request. Return a dictionary of (chosen_currency, values,
+        totals) tuples keyed by trip name.
+        """
+        trips_data = {}
+        for start in range(0, len(names), BATCH_GET_RANGES):
+            chunk = names[start:start + BATCH_GET_RANGES]
+            ranges = [
+                "'{}'!A:K".format(name.replace("'", "''")) for name in chunk
+            ]  # J1 holds the currency and K1 the running totals
+            response = SCHEDULER.read(
+                get_sheet().values_batch_get,
+                ranges,
+                dict(BATCH_GET_PARAMS)  # gspread adds the ranges to it
+            )
+            for name, value_range in zip(chunk, response["valueRanges"]):
+                data = value_range.get("values", [])
+                header = data[0] if data else HEADER
+                chosen_currency = header[9] if len(header) > 9 else ""
+                totals = (
+                    json.loads(header[10])
+                    if len(header) > 10 and header[10] else None
+                )
+                values = [list(HEADER)] + [
+                    row[:len(HEADER)] + [""] * (len(HEADER) - len(row))
+                    for row in data[1:]
+                ]
+                trips_data[name] = (chosen_currency, values, totals)
+        return trips_data
+
+    def get_all_trips_values(self):
+        self.check_snapshots()
+        all_values = {}
+        for name, (chosen_currency, values, totals) in self.read_trips(
+            self.trips()
+        ).items():
+            with self.lock:
+                self.registry.currencies.setdefault(name, chosen_currency)
+                self.snapshots.setdefault(name, {})["values"] = values
+            all_values[name] = (
+                chosen_currency, [list(row) for row in values]
+            )
+        return all_values
+
+    def prefetch(self, names):
+        generation = self.generation
+        names = [
+            name for name in names
+            if len(self.snapshots.get(name, {})) < 2
+        ]  # Values and totals already in the snapshot aren't read again
+        if not names:
+            return
+        trips_data = self.read_trips(names)
+        with self.lock:
+            if self.generation != generation:
+                return  # Changed while reading, the data may be stale
+            for name, (chosen_currency, values, totals) in trips_data.items():
+                self.registry.currencies.setdefault(name, chosen_currency)
+                snapshot = self.snapshots.setdefault(name, {})
+                snapshot.setdefault("values", values)
+                if totals is not None:
+                    snapshot.setdefault("totals", totals)
+
+    def get_totals(self, name):
+        totals = self.snapshot(name, "totals")
+        if totals is None:
+            values = SCHEDULER.read(
+                self.worksheet(name).get, "J1:K1", **RENDER_OPTIONS
+            )
+            row = values[0] if values else []
+            if row:
+                self.registry.currencies[name] = row[0]
+            if len(row) < 2 or not row[1]:
+                return None
+            totals = json.loads(row[1])
+            with self.lock:
+                self.snapshots.setdefault(name, {})["totals"] = totals
+        return copy.deepcopy(totals)
+
+    def save_totals(self, name, totals):
+        SCHEDULER.write(
+            self.worksheet(name).update,
+            "K1",
+            [[json.dumps(totals)]],
+            value_input_option="RAW"
+        )
+        self.written(name, "totals", copy.deepcopy(totals))
+
+    def rebase_trip(self, name, chosen_currency, converted, totals):
+        data = [{
+            "range": "J1:K1",
+            "values": [[chosen_currency, json.dumps(totals)]]
+        }]
+        if converted:
+            self.check_rows(name)
+            data.append({
+                "range": f"F2:G{len(converted) + 1}",
+                "values": converted
+            })  # Columns F:G hold the cost in the chosen currency
+        SCHEDULER.write(
+            self.worksheet(name).batch_update, data, value_input_option="RAW"
+        )
+        with self.lock:
+            self.generation += 1
+            self.registry.currencies[name] = chosen_currency
+            snapshot = self.snapshots.setdefault(name, {})
+            snapshot["totals"] = copy.deepcopy(totals)
+            for row, (cost, currency) in zip(
+                snapshot.get("values", [])[1:], converted
+            ):
+                row[5:7] = [cost, currency]
+        self.own_write(name)
+
+    def compact(self, names):
+        self.check_snapshots()
+        self.registry.load()  # The grid sizes as they are now
+        self.prefetch(names)
+        requests = []
+        freed = {}
+        for name in names:
+            worksheet = self.worksheet(name)
+            rows = min(worksheet.row_count, len(self.get_trip_values(name)))
+            cols = min(worksheet.col_count, TRIP_COLUMNS)
+            cells = worksheet.row_count * worksheet.col_count - rows * cols
+            if not cells:
+                continue
+            requests.append({
+                "updateSheetProperties": {
+                    "properties": {
+                        "sheetId": worksheet.id,
+                        "gridProperties": {
+                            "rowCount": rows, "columnCount": cols
+                        }
+                    },
+                    "fields": "gridProperties(rowCount,columnCount)"
+                }
+            })  # Rows past the last entry and columns past K are removed
+            freed[name] = cells
+        if requests:
+            SCHEDULER.write(get_sheet().batch_update, {"requests": requests})
+            self.own_write(*freed)
+        return freed
+
+    def exchange_rates(self):
+        worksheet_currencies = self.registry.worksheet("currency_exchange")
+        currencies_list = SCHEDULER.read(
+            worksheet_currencies.get_all_values, **RENDER_OPTIONS
+        )
+        history = {}
+        for row in currencies_list[1:]:  # Index 0 is the header
+            if len(row) < 4 or not (row[0] and row[2] and row[3] != ""):
+                continue
+            effective_date = None
+            if len(row) > 4 and str(row[4]).strip():  # Column E
+                try:
+                    effective_date = datetime.strptime(
+                        serial_to_date(row[4]).strip(), DATE_FORMAT
+                    ).date()
+                except ValueError:
+                    continue  # A rate that can't be placed in the history
+            rate = row[3]
+            if isinstance(rate, str):  # Rates entered as text
+                rate = float(rate.replace(",", "."))
+            history.setdefault((row[0], row[2]), []).append(
+                (effective_date, float(rate))
+            )
+        return history
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trips (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    chosen_currency TEXT NOT NULL,
+    totals TEXT
+);
+CREATE TABLE IF NOT EXISTS expenses (
+    id INTEGER PRIMARY KEY,
+    trip_id INTEGER NOT NULL REFERENCES trips (id) ON DELETE CASCADE,
+    date TEXT NOT NULL,
+    name TEXT NOT NULL,
+    concept TEXT NOT NULL,
+    cost REAL NOT NULL,
+    currency TEXT NOT NULL,
+    cost_chosen_currency REAL NOT NULL,
+    chosen_currency TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS expenses_trip_id ON expenses (trip_id, id);
+CREATE TABLE IF NOT EXISTS rates (
+    currency_base TEXT NOT NULL,
+    currency_other TEXT NOT NULL,
+    effective_date TEXT NOT NULL DEFAULT '',
+    rate REAL NOT NULL,
+    PRIMARY KEY (currency_base, currency_other, effective_date)
+);
+"""
+
+EXPENSE_COLUMNS = (
+    "date, name, concept, cost, currency, "
+    "cost_chosen_currency, chosen_currency"
+)
+
+# Dates are saved in the database as ISO dates, the format of the
+# SQLite date functions, or '' for legacy rows without a date. They are
+# converted from serial numbers by sqlite_row and to serial numbers in
+# the queries.
+EXPENSE_VALUES = "(?, ?, ?, ?, ?, ?, ?)"
+EXPENSE_SELECT = (
+    "COALESCE(CAST(julianday(expenses.date) - julianday('1899-12-30') "
+    "AS INTEGER), ''), "
+    "expenses.name, expenses.concept, expenses.cost, expenses.currency, "
+    "expenses.cost_chosen_currency, expenses.chosen_currency"
+)
+
+
+def sqlite_row(row):
+    """
+    Return an expense row with its serial number date as the ISO date
+    saved in the database. Legacy rows without a date keep it blank.
+    Raise ValueError if the date isn't a serial number.
+    """
+    serial = row[0]
+    if serial == "":
+        return list(row)
+    if (
+        isinstance(serial, bool)
+        or not isinstance(serial, (int, float))
+        or not float(serial).is_integer()
+    ):
+        raise ValueError(f"{serial!r} is not a serial number date.")
+    day = SERIAL_EPOCH + timedelta(days=int(serial))
+    return [day.isoformat(), *row[1:]]
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage backend saving trips, expenses and exchange rates
+    in a local SQLite database. It works offline and is used
+    for development and load testing.
+    """
+    def __init__(self, path=SQLITE_PATH):
+        """
+        Open the database, creating the tables if they don't exist.
+        A new database is populated with the DEFAULT_RATES, and the
+        dates of older databases are converted to ISO dates.
+        """
+        import sqlite3
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        with self.connection:
+            self.connection.executescript(SQLITE_SCHEMA)
+            trip_columns = [
+                column[1] for column in
+                self.connection.execute("PRAGMA table_info(trips)")
+            ]
+            if "totals" not in trip_columns:  # Database of older versions
+                self.connection.execute(
+                    "ALTER TABLE trips ADD COLUMN totals TEXT"
+                )
+            rate_columns = [
+                column[1] for column in
+                self.connection.execute("PRAGMA table_info(rates)")
+            ]
+            if "effective_date" not in rate_columns:
+                # Older versions kept one rate per pair. The effective
+                # date is part of the primary key, so the table is
+                # created again and the rates copied without a date.
+                self.connection.executescript(
+                    "ALTER TABLE rates RENAME TO rates_old;"
+                    + SQLITE_SCHEMA
+                    + "INSERT INTO rates (currency_base, currency_other, rate)"
+                    " SELECT * FROM rates_old; DROP TABLE rates_old;"
+                )
+            version, = self.connection.execute(
+                "PRAGMA user_version"
+            ).fetchone()
+            if version < 1:  # Dates were saved in the DATE_FORMAT
+                self.connection.execute(
+                    "UPDATE expenses SET date = substr(date, 7, 4) || '-' "
+                    "|| substr(date, 4, 2) || '-' || substr(date, 1, 2) "
+                    "WHERE date LIKE '__/__/____'"
+                )
+                self.connection.execute("PRAGMA user_version = 1")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO rates VALUES (?, ?, '', ?)",
+                [(base, other, rate)
+                 for (base, other), rate in DEFAULT_RATES.items()]
+            )
+
+    def trip_id(self, name):
+        """
+        Return the id of the trip.
+        Raise TripNotFound if there isn't one.
+        """
+        row = self.connection.execute(
+            "SELECT id FROM trips WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            raise TripNotFound(name)
+        return row[0]
+
+    def expense_id(self, name, entry_ind):
+        """
+        Return the id of the expense at the given index of the trip.
+        """
+        row = self.connection.execute(
+            "SELECT id FROM expenses WHERE trip_id = ? "
+            "ORDER BY id LIMIT 1 OFFSET ?",
+            (self.trip_id(name), entry_ind)
+        ).fetchone()
+        if row is None:
+            raise IndexError(f"The {name} trip has no entry {entry_ind}.")
+        return row[0]
+
+    def trips(self):
+        rows = self.connection.execute("SELECT name FROM trips ORDER BY id")
+        return [name for name, in rows]
+
+    def trip_exists(self, name):
+        row = self.connection.execute(
+            "SELECT 1 FROM trips WHERE name = ?", (name,)
+        ).fetchone()
+        return row is not None
+
+    def create_trip(self, name, chosen_currency):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO trips (name, chosen_currency, totals) "
+                "VALUES (?, ?, ?)",
+                (name, chosen_currency, json.dumps(empty_totals()))
+            )
+
+    def delete_trip(self, name):
+        trip_id = self.trip_id(name)
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM trips WHERE id = ?", (trip_id,)
+            )
+
+    def chosen_currency(self, name):
+        row = self.connection.execute(
+            "SELECT chosen_currency FROM trips WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            raise TripNotFound(name)
+        return row[0]
+
+    def get_trip_values(self, name):
+        rows = self.connection.execute(
+            f"SELECT {EXPENSE_SELECT} FROM expenses "
+            "WHERE trip_id = ? ORDER BY id",
+            (self.trip_id(name),)
+        )
+        return [list(HEADER)] + [list(row) for row in rows]
+
+    def get_expense(self, name, entry_ind):
+        row = self.connection.execute(
+            f"SELECT {EXPENSE_SELECT} FROM expenses WHERE id = ?",
+            (self.expense_id(name, entry_ind),)
+        ).fetchone()
+        return list(row)
+
+    def entry_count(self, name):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM expenses WHERE trip_id = ?",
+            (self.trip_id(name),)
+        ).fetchone()[0]
+
+    def append_expense(self, name, row):
+        trip_id = self.trip_id(name)
+        with self.connection:
+            self.connection.execute(
+                f"INSERT INTO expenses (trip_id, {EXPENSE_COLUMNS}) "
+                f"SELECT ?, * FROM (VALUES {EXPENSE_VALUES})",
+                [trip_id, *sqlite_row(row)]
+            )
+
+    def update_expense(self, name, entry_ind, row, old_row=None):
+        expense_id = self.expense_id(name, entry_ind)
+        with self.connection:
+            self.connection.execute(
+                f"UPDATE expenses SET ({EXPENSE_COLUMNS}) = "
+                f"{EXPENSE_VALUES} WHERE id = ?",
+                [*sqlite_row(row), expense_id]
+            )
+
+    def append_expenses(self, name, rows):
+        trip_id = self.trip_id(name)
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO expenses (trip_id, {EXPENSE_COLUMNS}) "
+                f"SELECT ?, * FROM (VALUES {EXPENSE_VALUES})",
+                [[trip_id, *sqlite_row(row)] for row in rows]
+            )
+
+    def update_expenses(self, name, rows):
+        expense_ids = self.connection.execute(
+            "SELECT id FROM expenses WHERE trip_id = ? ORDER BY id",
+            (self.trip_id(name),)
+        ).fetchall()
+        with self.connection:
+            self.connection.executemany(
+                f"UPDATE expenses SET ({EXPENSE_COLUMNS}) = "
+                f"{EXPENSE_VALUES} WHERE id = ?",
+                [[*sqlite_row(row), expense_ids[entry_ind][0]]
+                 for entry_ind, row in rows.items()]
+            )
+
+    def delete_expense(self, name, entry_ind):
+        expense_id = self.expense_id(name, entry_ind)
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM expenses WHERE id = ?", (expense_id,)
+            )
+
+    def delete_expenses(self, name, entry_inds):
+        expense_ids = self.connection.execute(
+            "SELECT id FROM expenses WHERE trip_id = ? ORDER BY id",
+            (self.trip_id(name),)
+        ).fetchall()
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM expenses WHERE id = ?",
+                [expense_ids[entry_ind] for entry_ind in set(entry_inds)]
+            )
+
+    def exchange_rates(self):
+        history = {}
+        for base, other, effective_date, rate in self.connection.execute(
+            "SELECT * FROM rates"
+        ):  # Effective dates are saved as ISO dates, or '' if undated
+            history.setdefault((base, other), []).append((
+                date.fromisoformat(effective_date) if effective_date
+                else None,
+                rate
+            ))
+        return history
+
+    def get_all_trips_values(self):
+        all_values = {
+            name: (chosen_currency, [list(HEADER)])
+            for name, chosen_currency in self.connection.execute(
+                "SELECT name, chosen_currency FROM trips ORDER BY id"
+            )
+        }
+        rows = self.connection.execute(
+            f"SELECT trips.name, {EXPENSE_SELECT} FROM expenses "
+            "JOIN trips ON trips.id = expenses.trip_id ORDER BY expenses.id"
+        )
+        for name, *row in rows:
+            all_values[name][1].append(row)
+        return all_values
+
+    def get_totals(self, name):
+        row = self.connection.execute(
+            "SELECT totals FROM trips WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            raise TripNotFound(name)
+        return json.loads(row[0]) if row[0] else None
+
+    def save_totals(self, name, totals):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE trips SET totals = ? WHERE name = ?",
+                (json.dumps(totals), name)
+            )
+
+    def rebase_trip(self, name, chosen_currency, converted, totals):
+        trip_id = self.trip_id(name)
+        expense_ids = self.connection.execute(
+            "SELECT id FROM expenses WHERE trip_id = ? ORDER BY id",
+            (trip_id,)
+        ).fetchall()
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE expenses SET cost_chosen_currency = ?, "
+                "chosen_currency = ? WHERE id = ?",
+                [
+                    (cost, currency, expense_id)
+                    for (cost, currency), (expense_id,)
+                    in zip(converted, expense_ids)
+                ]
+            )
+            self.connection.execute(
+                "UPDATE trips SET chosen_currency = ?, totals = ? "
+                "WHERE id = ?",
+                (chosen_currency, json.dumps(totals), trip_id)
+            )
+
+
+class WriteBehindStorage(Storage):
+    """
+    Storage wrapper keeping new and edited expenses in memory
+    and saving them to the wrapped backend in batches.
+    Reads include the pending rows so they are displayed as usual.
+    """
+    def __init__(
+        self,
+        backend,
+        max_rows=WRITE_BEHIND_MAX_ROWS,
+        max_age=WRITE_BEHIND_MAX_AGE
+    ):
+        """
+        Initialize the wrapper with no pending rows.
+        """
+        self.backend = backend
+        self.remote = backend.remote
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.pending_appends = {}  # Trip name: list of new rows
+        self.pending_updates = {}  # Trip name: {entry index: row}
+        self.pending_totals = {}  # Trip name: running totals
+        self.saved_counts = {}  # Trip name: number of saved rows
+        self.write_ids = {}  # Trip name: id of the last buffered write
+        self.saved_ids = {}  # Trip name: id of the last saved write
+        self.oldest_pending = None
+
+    def saved_count(self, name):
+        """
+        Return the number of rows of the trip already saved.
+        """
+        if name not in self.saved_counts:
+            self.saved_counts[name] = self.backend.entry_count(name)
+        return self.saved_counts[name]
+
+    def pending_trips(self, name=None):
+        """
+        Return the trip names to consider: the given one or,
+        if no name is given, every trip with pending rows.
+        """
+        if name is not None:
+            return [name]
+        return (
+            set(self.pending_appends)
+            | set(self.pending_updates)
+            | set(self.pending_totals)
+        )
+
+    def pending_count(self, name=None):
+        return sum(
+            len(self.pending_appends.get(trip, []))
+            + len(self.pending_updates.get(trip, {}))
+            for trip in self.pending_trips(name)
+        )
+
+    def flush(self, name=None):
+        # Pending rows are dropped only once the backend has saved them,
+        # so that a flush that fails can be tried again
+        changed = []
+        for name in self.pending_trips(name):
+            write_id = self.write_ids.get(name, 0)
+            updates = self.pending_updates.get(name)
+            if updates:
+                try:
+                    self.backend.update_expenses(name, dict(updates))
+                except TripChanged:
+                    # The edited rows have moved, so the edits are
+                    # dropped and the totals rebuilt without them
+                    changed.append(name)
+                    self.pending_totals.pop(name, None)
+                del self.pending_updates[name]
+            appends = self.pending_appends.get(name)
+            if appends:
+                self.backend.append_expenses(name, list(appends))
+                del self.pending_appends[name]
+                if name in self.saved_counts:
+                    self.saved_counts[name] += len(appends)
+            if name in changed:
+                self.backend.save_totals(
+                    name,
+                    ExpenseBatch.from_values(
+                        self.backend.get_trip_values(name)
+                    ).totals()
+                )
+            if name in self.pending_totals:
+                self.backend.save_totals(name, self.pending_totals[name])
+                del self.pending_totals[name]
+            self.saved_ids[name] = write_id
+        if self.pending_count() == 0:
+            self.oldest_pending = None
+        if changed:
+            raise TripChanged(changed[0])
+
+    def write_id(self, name):
+        return self.write_ids.get(name, 0)
+
+    def is_saved(self, name, write_id):
+        return write_id <= self.saved_ids.get(name, 0)
+
+    def buffered(self, name):
+        """
+        Count a write kept in memory for the trip.
+        """
+        self.write_ids[name] = self.write_ids.get(name, 0) + 1
+
+    def flush_if_due(self):
+        """
+        Save all pending rows if there are too many of them
+        or the oldest one has waited too long.
+        """
+        if self.oldest_pending is None:
+            return
+        if (
+            self.pending_count() >= self.max_rows
+            or time.monotonic() - self.oldest_pending >= self.max_age
+        ):
+            self.flush()
+
+    def trips(self):
+        return self.backend.trips()
+
+    def trip_exists(self, name):
+        return self.backend.trip_exists(name)
+
+    def create_trip(self, name, chosen_currency):
+        self.backend.create_trip(name, chosen_currency)
+        self.saved_counts[name] = 0
+
+    def delete_trip(self, name):
+        self.pending_appends.pop(name, None)
+        self.pending_updates.pop(name, None)
+        self.pending_totals.pop(name, None)
+        self.saved_counts.pop(name, None)
+        self.backend.delete_trip(name)
+        self.saved_ids[name] = self.write_ids.get(name, 0)
+
+    def chosen_currency(self, name):
+        return self.backend.chosen_currency(name)
+
+    def add_pending(self, name, data):
+        """
+        Apply the pending rows of the trip to the values read
+        from the backend and return them.
+        """
+        self.saved_counts[name] = len(data) - 1
+        for entry_ind, row in self.pending_updates.get(name, {}).items():
+            data[entry_ind + 1] = list(row)
+        for row in self.pending_appends.get(name, []):
+            data.append(list(row))
+        return data
+
+    def get_trip_values(self, name):
+        self.flush_if_due()
+        return self.add_pending(name, self.backend.get_trip_values(name))
+
+    def get_all_trips_values(self):
+        self.flush_if_due()
+        return {
+            name: (chosen_currency, self.add_pending(name, data))
+            for name, (chosen_currency, data)
+            in self.backend.get_all_trips_values().items()
+        }
+
+    def prefetch(self, names):
+        self.backend.prefetch(names)
+
+    def compact(self, names):
+        for name in names:
+            self.flush(name)  # Pending rows go into the space kept
+        return self.backend.compact(names)
+
+    def get_expense(self, name, entry_ind):
+        if entry_ind in self.pending_updates.get(name, {}):
+            row = self.pending_updates[name][entry_ind]
+        elif entry_ind >= self.saved_count(name):
+            row = self.pending_appends[name][
+                entry_ind - self.saved_count(name)
+            ]
+        else:
+            return self.backend.get_expense(name, entry_ind)
+        return list(row)
+
+    def entry_count(self, name):
+        return self.saved_count(name) + len(
+            self.pending_appends.get(name, [])
+        )
+
+    def append_expense(self, name, row):
+        self.append_expenses(name, [row])
+
+    def append_expenses(self, name, rows):
+        # Buffered together, so that a batch is saved in one request
+        self.pending_appends.setdefault(name, []).extend(rows)
+        self.buffered(name)
+        self.row_added()
+
+    def update_expense(self, name, entry_ind, row, old_row=None):
+        self.update_expenses(name, {entry_ind: row})
+
+    def update_expenses(self, name, rows):
+        self.buffered(name)
+        updated = False
+        for entry_ind, row in rows.items():
+            if entry_ind >= self.saved_count(name):
+                self.pending_appends[name][
+                    entry_ind - self.saved_count(name)
+                ] = row
+            else:
+                self.pending_updates.setdefault(name, {})[entry_ind] = row
+                updated = True
+        if updated:
+            self.row_added()
+
+    def row_added(self):
+        """
+        Start the timer of the oldest pending row if needed
+        and save the pending rows if a threshold is reached.
+        """
+        if self.oldest_pending is None:
+            self.oldest_pending = time.monotonic()
+        self.flush_if_due()
+
+    def delete_expense(self, name, entry_ind):
+        self.flush(name)  # Saved first, so the indexes match the backend
+        self.backend.delete_expense(name, entry_ind)
+        self.saved_counts[name] = self.saved_count(name) - 1
+
+    def delete_expenses(self, name, entry_inds):
+        self.flush(name)
+        self.backend.delete_expenses(name, entry_inds)
+        self.saved_counts[name] = (
+            self.saved_count(name) - len(set(entry_inds))
+        )
+
+    def exchange_rates(self):
+        return self.backend.exchange_rates()
+
+    def get_totals(self, name):
+        if name in self.pending_totals:
+            return self.pending_totals[name]
+        return self.backend.get_totals(name)
+
+    def save_totals(self, name, totals):
+        self.pending_totals[name] = totals
+        self.buffered(name)
+
+    def rebase_trip(self, name, chosen_currency, converted, totals):
+        self.flush(name)
+        self.backend.rebase_trip(name, chosen_currency, converted, totals)
+
+
+class Journal:
+    """
+    Append-only file of JSON lines recording the changes made to the
+    storage. Each entry is written to disk before the change is made,
+    and acknowledged once the storage has saved it.
+    """
+    def __init__(self, path):
+        """
+        Initialize the journal. The file is opened on the first write.
+        """
+        self.path = path
+        self.file = None
+        self.next_id = 1
+
+    def read(self):
+        """
+        Return the entries not acknowledged, in the order they were made.
+        """
+        entries = {}
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by a crash
+                if "ack" in record:
+                    for entry_id in record["ack"]:
+                        entries.pop(entry_id, None)
+                else:
+                    entries[record["id"]] = record
+                    self.next_id = max(self.next_id, record["id"] + 1)
+        return list(entries.values())
+
+    def write(self, record):
+        """
+        Add a record to the file and wait until it is on disk.
+        """
+        if self.file is None:
+            self.file = open(self.path, "a+", encoding="utf-8")
+            self.file.seek(0, os.SEEK_END)
+            if self.file.tell():
+                self.file.write("\n")  # In case the last line was cut
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, op, **args):
+        """
+        Write a new entry for a change and return its id.
+        """
+        entry_id = self.next_id
+        self.next_id += 1
+        self.write({"id": entry_id, "op": op, **args})
+        return entry_id
+
+    def acknowledge(self, entry_ids):
+        """
+        Mark the entries as saved by the storage.
+        """
+        self.write({"ack": list(entry_ids)})
+
+    def compact(self):
+        """
+        Empty the file. Only called when every entry is acknowledged.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            open(self.path, "w").close()
+
+
+class StorageUnavailable(Exception):
+    """
+    Raised when a change recorded in the journal can't be sent
+    to the storage.
+    """
+    def __str__(self):
+        return (
+            "The storage can't be reached. The changes are kept in the "
+            "journal and will be sent the next time the program starts."
+        )
+
+
+class JournalStorage(Storage):
+    """
+    Storage wrapper recording every change in a Journal before
+    passing it to the wrapped backend.
+    Changes are acknowledged once the backend confirms it has saved
+    them, which may be later than when they are made if it buffers
+    writes.
+    If the backend can't be reached the change stays in the journal,
+    StorageUnavailable is raised and replay() sends it on the next start.
+    """
+    def __init__(self, backend, path=JOURNAL_PATH):
+        """
+        Initialize the wrapper with the journal file at the given path.
+        """
+        self.backend = backend
+        self.remote = backend.remote
+        self.journal = Journal(path)
+        # (entry id, trip name, backend write id) of the changes made
+        # and not acknowledged yet
+        self.outstanding = []
+
+    def change(self, op, make_change, **args):
+        """
+        Record the change in the journal, then make it.
+        Network errors leave the change unsent, so it's never
+        acknowledged in this session, and raise StorageUnavailable.
+        """
+        entry_id = self.journal.record(op, **args)
+        try:
+            make_change()
+        except TripChanged:
+            self.journal.acknowledge([entry_id])  # Refused, never replayed
+            raise
+        except Exception as error:
+            if retry_status(error) is None:
+                raise
+            raise StorageUnavailable() from error
+        self.outstanding.append(
+            (entry_id, args["name"], self.backend.write_id(args["name"]))
+        )
+
+    def acknowledge(self):
+        """
+        Acknowledge the changes the backend confirms it has saved.
+        """
+        saved = [
+            entry_id for entry_id, name, write_id in self.outstanding
+            if self.backend.is_saved(name, write_id)
+        ]
+        if saved:
+            self.journal.acknowledge(saved)
+        self.outstanding = [
+            change for change in self.outstanding if change[0] not in saved
+        ]
+
+    def trips(self):
+        return self.backend.trips()
+
+    def trip_exists(self, name):
+        return self.backend.trip_exists(name)
+
+    def create_trip(self, name, chosen_currency):
+        self.change(
+            "create_trip",
+            lambda: self.backend.create_trip(name, chosen_currency),
+            name=name,
+            chosen_currency=chosen_currency
+        )
+        self.acknowledge()
+
+    def delete_trip(self, name):
+        self.change(
+            "delete_trip", lambda: self.backend.delete_trip(name), name=name
+        )
+        self.acknowledge()
+
+    def chosen_currency(self, name):
+        return self.backend.chosen_currency(name)
+
+    def get_trip_values(self, name):
+        return self.backend.get_trip_values(name)
+
+    def get_all_trips_values(self):
+        return self.backend.get_all_trips_values()
+
+    def prefetch(self, names):
+        self.backend.prefetch(names)
+
+    def compact(self, names):
+        # Only the space around the entries changes, so there's
+        # nothing to record, but pending rows may be saved first
+        freed = self.backend.compact(names)
+        self.acknowledge()
+        return freed
+
+    def get_expense(self, name, entry_ind):
+        return self.backend.get_expense(name, entry_ind)
+
+    def entry_count(self, name):
+        return self.backend.entry_count(name)
+
+    def append_expense(self, name, row):
+        self.change(
+            "append_expenses",
+            lambda: self.backend.append_expense(name, row),
+            name=name,
+            rows=[row],
+            row_count=self.backend.entry_count(name)
+        )
+        self.acknowledge()
+
+    def append_expenses(self, name, rows):
+        self.change(
+            "append_expenses",
+            lambda: self.backend.append_expenses(name, rows),
+            name=name,
+            rows=rows,
+            row_count=self.backend.entry_count(name)
+        )
+        self.acknowledge()
+
+    def update_expense(self, name, entry_ind, row, old_row=None):
+        if old_row is None:
+            old_row = self.backend.get_expense(name, entry_ind)
+        self.change(
+            "update_expenses",
+            lambda: self.backend.update_expense(name, entry_ind, row),
+            name=name,
+            rows={entry_ind: row},
+            old_rows={entry_ind: old_row}
+        )
+        self.acknowledge()
+
+    def update_expenses(self, name, rows):
+        values = self.backend.get_trip_values(name)
+        self.change(
+            "update_expenses",
+            lambda: self.backend.update_expenses(name, rows),
+            name=name,
+            rows=rows,
+            old_rows={entry_ind: values[entry_ind + 1] for entry_ind in rows}
+        )
+        self.acknowledge()
+
+    def delete_expense(self, name, entry_ind):
+        self.record_deletes(
+            name,
+            [entry_ind],
+            lambda: self.backend.delete_expense(name, entry_ind)
+        )
+
+    def delete_expenses(self, name, entry_inds):
+        self.record_deletes(
+            name,
+            entry_inds,
+            lambda: self.backend.delete_expenses(name, entry_inds)
+        )
+
+    def record_deletes(self, name, entry_inds, make_change):
+        """
+        Record the deleted rows and the number of rows before
+        deleting them, so that replay() can tell if it was done.
+        """
+        values = self.backend.get_trip_values(name)
+        self.change(
+            "delete_expenses",
+            make_change,
+            name=name,
+            old_rows={
+                entry_ind: values[entry_ind + 1] for entry_ind in entry_inds
+            },
+            row_count=len(values) - 1
+        )
+        self.acknowledge()
+
+    def exchange_rates(self):
+        return self.backend.exchange_rates()
+
+    def get_totals(self, name):
+        return self.backend.get_totals(name)
+
+    def save_totals(self, name, totals):
+        # The totals aren't kept in the journal: replay() rebuilds
+        # them from the entries. The entry is acknowledged with the
+        # next change, so the totals are rebuilt after a crash.
+        self.change(
+            "save_totals",
+            lambda: self.backend.save_totals(name, totals),
+            name=name
+        )
+
+    def rebase_trip(self, name, chosen_currency, converted, totals):
+        # Replayed by converting the entries again, so only the
+        # currency is kept in the journal
+        self.change(
+            "rebase_trip",
+            lambda: self.backend.rebase_trip(
+                name, chosen_currency, converted, totals
+            ),
+            name=name,
+            chosen_currency=chosen_currency
+        )
+        self.acknowledge()
+
+    def pending_count(self, name=None):
+        return self.backend.pending_count(name)
+
+    def flush(self, name=None):
+        try:
+            self.backend.flush(name)
+        except TripChanged:
+            self.acknowledge()  # The edits refused are dropped
+            raise
+        except Exception as error:
+            if retry_status(error) is None:
+                raise
+            raise StorageUnavailable() from error
+        self.acknowledge()
+
+    def replay(self):
+        """
+        Send the changes of the journal that were never acknowledged,
+        skipping the ones the backend already has, then rebuild the
+        running totals of the trips they changed.
+        """
+        entries = self.journal.read()
+        if not entries:
+            self.journal.compact()  # Drop the last session's changes and acks
+            return
+        print(
+            "Sending 1 change kept in the journal..."
+            if len(entries) == 1
+            else f"Sending {len(entries)} changes kept in the journal..."
+        )
+        changed_trips = []
+        for entry in entries:
+            try:
+                result = self.replay_entry(entry)
+            except Exception as error:
+                if retry_status(error) is not None:
+                    print(
+                        Fore.YELLOW + "The storage can't be reached. "
+                        "The changes will be sent on the next start."
+                    )
+                    return
+                result = str(error)
+            if result is not None:
+                print(
+                    Fore.YELLOW + f"A change to {entry['name']} was "
+                    f"skipped: {result}"
+                )
+            if entry["name"] not in changed_trips:
+                changed_trips.append(entry["name"])
+            self.journal.acknowledge([entry["id"]])
+        for name in changed_trips:
+            if self.backend.trip_exists(name):
+                self.backend.save_totals(
+                    name, load_trip_batch(name).totals()
+                )
+        self.backend.flush()
+        if self.backend.pending_count() == 0:
+            self.journal.compact()
+
+    def replay_entry(self, entry):
+        """
+        Make the change of a journal entry if the backend doesn't
+        have it yet. Return None, or the reason why the change
+        was skipped.
+        """
+        name = entry["name"]
+        op = entry["op"]
+        if op == "create_trip":
+            if not self.backend.trip_exists(name):
+                self.backend.create_trip(name, entry["chosen_currency"])
+            return None
+        if not self.backend.trip_exists(name):
+            return None if op == "delete_trip" else "the trip doesn't exist."
+        if op == "delete_trip":
+            self.backend.delete_trip(name)
+            return None
+        if op == "save_totals":
+            return None  # Rebuilt by replay()
+        if op == "rebase_trip":
+            converted, totals = rebase_values(
+                self.backend.get_trip_values(name), entry["chosen_currency"]
+            )
+            self.backend.rebase_trip(
+                name, entry["chosen_currency"], converted, totals
+            )
+            return None
+
+        values = self.backend.get_trip_values(name)[1:]
+        if op == "append_expenses":
+            start = entry["row_count"]
+            saved = values[start:start + len(entry["rows"])]
+            if len(saved) < len(entry["rows"]) or not all(
+                same_values(saved_row, row)
+                for saved_row, row in zip(saved, entry["rows"])
+            ):
+                self.backend.append_expenses(name, entry["rows"])
+            return None
+
+        old_rows = {
+            int(entry_ind): row for entry_ind, row in entry["old_rows"].items()
+        }  # JSON keys are strings
+        if op == "update_expenses":
+            rows = {
+                int(entry_ind): row for entry_ind, row in entry["rows"].items()
+            }
+            if any(entry_ind >= len(values) for entry_ind in rows):
+                return "the entries have changed since."
+            updates = {}
+            for entry_ind, row in rows.items():
+                if same_values(values[entry_ind], row):
+                    continue
+                if not same_values(values[entry_ind], old_rows[entry_ind]):
+                    return "the entries have changed since."
+                updates[entry_ind] = row
+            if updates:
+                self.backend.update_expenses(name, updates)
+            return None
+        if op == "delete_expenses":
+            if len(values) == entry["row_count"] - len(old_rows):
+                return None  # Already deleted
+            if len(values) != entry["row_count"] or not all(
+                same_values(values[entry_ind], row)
+                for entry_ind, row in old_rows.items()
+            ):
+                return "the entries have changed since."
+            self.backend.delete_expenses(name, list(old_rows))
+            return None
+        return f"unknown change {op}."
+
+
+STORAGE = SheetsStorage()
+
+
+class ExchangeRateNotFound(KeyError):
+    """
+    Raised when the exchange rate between two currencies
+    is not in the exchange rates table.
+    """
+    def __str__(self):
+        currency_base, currency_other = self.args
+        return (
+            f"There is no exchange rate from {currency_base} "
+            f"to {currency_other}."
+        )
+
+
+def rate_on(days, rates, day):
+    """
+    Return the rate of a history in effect on the day, found with
+    a binary search. Days before the first effective day use the
+    first rate.
+    """
+    return rates[max(bisect.bisect_right(days, day) - 1, 0)]
+
+
+class ExchangeRates:
+    """
+    In-process cache of the 'currency_exchange' worksheet.
+    The whole table is read once and kept in a dictionary keyed by
+    (currency_base, currency_other) until it is older than the ttl.
+    Each pair keeps its history of rates as two lists sorted by
+    effective date, so the rate in effect on a date is found with
+    a binary search. Dates are stored as day numbers (date.toordinal).
+    Any currency with a rate against the PIVOT_CURRENCY can be used:
+    the rates between two such currencies are triangulated through
+    the pivot the first time they are needed.
+    """
+    def __init__(self, ttl=RATES_TTL):
+        """
+        Initialize an empty cache. Rates are loaded on first use.
+        """
+        self.ttl = ttl
+        self.rates = {}  # (base, other): (effective days, rates)
+        self.pivot_rates = {}  # Currency: (days, units per pivot unit)
+        self.codes = []  # Sorted currency codes
+        self.loaded = 0
+        self.loaded_at = None
+        # Refreshed by a prefetch thread while the main thread
+        # may be adding triangulated pairs
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Read the exchange rates from the storage and rebuild the table.
+        Undated rates take day 0, before any dated rate.
+        Rates given for a pair take precedence over triangulated ones.
+        """
+        rates = {}
+        for pair, history in STORAGE.exchange_rates().items():
+            history = sorted(
+                (effective_date.toordinal() if effective_date else 0, rate)
+                for effective_date, rate in history
+            )
+            rates[pair] = (
+                [day for day, rate in history],
+                [rate for day, rate in history]
+            )
+
+        pivot_rates = {PIVOT_CURRENCY: ([0], [1.0])}
+        for (base, other), (days, values) in rates.items():
+            if base == PIVOT_CURRENCY and other != base:
+                pivot_rates[other] = (days, values)
+        for (base, other), (days, values) in rates.items():
+            if other == PIVOT_CURRENCY and base not in pivot_rates:
+                pivot_rates[base] = (days, [1 / value for value in values])
+
+        with self.lock:
+            self.rates = rates
+            self.pivot_rates = pivot_rates
+            self.codes = sorted(
+                set(pivot_rates).union(*rates)
+            )  # Every currency of the pivot rates and the pairs
+            self.loaded = sum(
+                len(values) for days, values in rates.values()
+            )
+            self.loaded_at = time.monotonic()
+
+    def load(self):
+        """
+        Load the table if it was never loaded or the ttl has expired.
+        """
+        PREFETCHER.wait("rates")
+        if self.is_stale():
+            self.refresh()
+
+    def count(self):
+        """
+        Return the number of rates loaded, counting every date.
+        """
+        return self.loaded
+
+    def currencies(self):
+        """
+        Return the codes of all the currencies with exchange rates.
+        """
+        self.load()
+        return list(self.codes)
+
+    def history(self, currency_base, currency_other):
+        """
+        Return the effective days and rates of the pair,
+        loading the table first if needed. The history of a pair
+        triangulated through the pivot has a rate for every day
+        on which either of its pivot rates changes.
+        Raise ExchangeRateNotFound if there's no rate for the pair.
+        """
+        self.load()
+        pair = (currency_base, currency_other)
+        with self.lock:
+            if pair not in self.rates:
+                if (
+                    currency_base not in self.pivot_rates
+                    or currency_other not in self.pivot_rates
+                ):
+                    raise ExchangeRateNotFound(currency_base, currency_other)
+                base_days, base_rates = self.pivot_rates[currency_base]
+                other_days, other_rates = self.pivot_rates[currency_other]
+                days = sorted(set(base_days) | set(other_days))
+                self.rates[pair] = (days, [
+                    rate_on(other_days, other_rates, day)
+                    / rate_on(base_days, base_rates, day)
+                    for day in days
+                ])
+            return self.rates[pair]
+
+    def is_stale(self):
+        """
+        Return True if the rates were never loaded or the ttl has expired.
+        """
+        return (
+            self.loaded_at is None
+            or time.monotonic() - self.loaded_at > self.ttl
+        )
+
+    def get_rate(self, currency_base, currency_other, expense_date=None):
+        """
+        Return the exchange rate from currency_base to currency_other
+        in effect on the expense date (a DATE_FORMAT string), or the
+        latest rate if no date is given, found with a binary search
+        in the history of the pair.
+        Dates before the first effective date use the first rate.
+        Raise ExchangeRateNotFound if there's no rate for the pair.
+        """
+        days, rates = self.history(currency_base, currency_other)
+        if expense_date is None:
+            return rates[-1]
+        day = datetime.strptime(expense_date, DATE_FORMAT).toordinal()
+        return rate_on(days, rates, day)
+
+    def get_rates(self, currency_base, currency_other, dates):
+        """
+        Return an array with the rate in effect on each date of an
+        array of datetime64 dates, with a single searchsorted call.
+        Invalid dates (NaT) use the latest rate.
+        """
+        import numpy as np
+
+        days, rates = self.history(currency_base, currency_other)
+        expense_days = (
+            dates.astype("datetime64[D]") - np.datetime64("0001-01-01")
+        ).astype(np.int64) + 1  # The same day numbers as date.toordinal
+        expense_days[np.isnat(dates)] = days[-1]
+        positions = np.searchsorted(days, expense_days, side="right") - 1
+        return np.asarray(rates)[np.maximum(positions, 0)]
+
+
+EXCHANGE_RATES = ExchangeRates()
+
+
+class Prefetcher:
+    """
+    Pool of background threads reading the trips and the exchange
+    rates while the user is choosing a trip from the list.
+    Prefetch requests aren't retried: if one fails, the data is read
+    again when it's needed. Only remote storage backends are read
+    ahead of time: local ones are fast enough, and an SQLite
+    connection can't be used from another thread.
+    """
+    def __init__(self, workers=PREFETCH_WORKERS):
+        """
+        Initialize the prefetcher. Threads are started on first use.
+        """
+        self.workers = workers
+        self.executor = None
+        self.futures = {}  # Trip name or "rates": future reading it
+
+    def start(self, trip_names):
+        """
+        Start reading the trips not being read already, in groups of
+        BATCH_GET_RANGES trips, and the exchange rates if they are stale.
+        """
+        if self.workers < 1 or not STORAGE.remote:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix="prefetch",
+                initializer=SCHEDULER.disable_retries
+            )
+        if EXCHANGE_RATES.is_stale() and not self.running("rates"):
+            self.futures["rates"] = self.executor.submit(
+                EXCHANGE_RATES.refresh
+            )
+        trip_names = [
+            name for name in trip_names if not self.running(name)
+        ]
+        for start in range(0, len(trip_names), BATCH_GET_RANGES):
+            chunk = trip_names[start:start + BATCH_GET_RANGES]
+            future = self.executor.submit(STORAGE.prefetch, chunk)
+            for name in chunk:
+                self.futures[name] = future
+
+    def running(self, key):
+        """
+        Return True if the trip or the rates are being read.
+        """
+        return key in self.futures and not self.futures[key].done()
+
+    def wait(self, key):
+        """
+        Wait until the trip or the rates being read are ready,
+        instead of reading them again. Errors are ignored.
+        """
+        if key in self.futures:
+            wait([self.futures.pop(key)])
+
+    def cancel(self):
+        """
+        Cancel the reads not started yet and stop the threads.
+        Reads in progress end after a single request.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.futures = {}
+
+
+PREFETCHER = Prefetcher()
+
+
+class Expense:
+    """
+    Expense class.
+    Contains all necessary attributes that a user must provide.
+    Chosen currency and exchange rate are returned trhough the methods.
+    FIELDS lists the attributes saved in the first HEADER columns,
+    in the same order.
+    """
+    FIELDS = ("date", "name", "concept", "cost", "currency")
+    __slots__ = ("trip_name",) + FIELDS
+
+    def __init__(self, trip_name, date, name, concept, cost, currency):
+        """
+        Initialize the Expense object.
+        """
+        self.trip_name = trip_name
+        self.date = date
+        self.name = name
+        self.concept = concept
+        self.cost = cost
         self.currency = currency
 
     def get_chosen_currency(self):
         """
         Retrieves the chosen currency from the worksheet an return its value.
         """
-        worksheet = SHEET.worksheet(self.trip_name)
-        chosen_currency = worksheet.acell(
-            "J1"
-        ).value  # J1 is the cell storing the value in crate_new_trip()
+        chosen_currency = STORAGE.chosen_currency(self.trip_name)
         return chosen_currency
 
     def get_exchange_rate(self):
         """
-        Get the exchage rate from the 'currency_exchange' worksheet.
+        Get the exchage rate from the cached 'currency_exchange' worksheet.
         Return the value based on the currencies entered by the user
         when creating the trip and expense.
         """
-        worksheet_currencies = SHEET.worksheet("currency_exchange")
-        currencies_list = worksheet_currencies.get_all_values()
+        currency_base = self.currency
+        currency_other = STORAGE.chosen_currency(self.trip_name)
 
-        worksheet_trip = SHEET.worksheet(self.trip_name)
+        exchange_rate = EXCHANGE_RATES.get_rate(
+            currency_base, currency_other, self.date or None
+        )  # The rate in effect on the day of the expense, if it has one
+        return exchange_rate
 
-        currency_base = self.currency
-        currency_other = worksheet_trip.acell('J1').value
-        matching_row = 0
+    @classmethod
+    def from_row(cls, trip_name, row):
+        """
+        Create the expense from a row of the trip storage.
+        """
+        date, name, concept, cost, currency = row[:len(cls.FIELDS)]
+        return cls(
+            trip_name,
+            serial_to_date(date).strip(),  # Blank in some legacy rows
+            name,
+            concept,
+            from_cents(to_cents(cost)),
+            currency
+        )
 
-        # Loop to find the row where base currency and currency other match
-        for row in currencies_list:
-            if row[0] == currency_base and row[2] == currency_other:
-                matching_row = row
-                break
+    def fields(self):
+        """
+        Return a list of (field, value) tuples entered by the user.
+        """
+        return [(field, getattr(self, field)) for field in self.FIELDS]
 
-        exchange_rate = matching_row[3]
-        return exchange_rate
+    def to_row(self):
+        """
+        Return the row to save, in the HEADER column order.
+        The date is saved as a serial number, or left blank if a legacy
+        row has none, and the cost and its conversion to the chosen
+        currency of the trip in whole cents.
+        """
+        cents = to_cents(self.cost)
+        return [
+            date_to_serial(self.date) if self.date else "",
+            self.name,
+            self.concept,
+            from_cents(cents),
+            self.currency,
+            from_cents(round(cents * self.get_exchange_rate())),
+            self.get_chosen_currency()
+        ]
+
+
+class ExpenseBatch:
+    """
+    Expenses stored by column in NumPy arrays, in the HEADER order.
+    Dates are datetime64 (NaT if invalid) and costs float64 (NaN if
+    invalid), in whole cents once they are saved. Text columns are
+    stored as small integer codes into the list of their distinct
+    values, so large trips don't need a Python object per value.
+    """
+    TEXT_COLUMNS = ("Name", "Concept", "Currency", "Chosen_currency")
+    COST_COLUMNS = ("Cost", "Cost_chosen_currency")
+    __slots__ = ("columns",)
+
+    def __init__(self, columns):
+        """
+        Initialize the batch with a dictionary of columns: an array
+        for dates and costs, and a (codes, values) tuple for text.
+        """
+        self.columns = columns
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Parse the values of a trip, header first, as returned by
+        Storage.get_trip_values, with every column at once.
+        """
+        return cls.from_rows(values[1:])
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Parse expense rows in the HEADER order. Rows may end after
+        the currency, before they are converted to the trip currency.
+        Dates may be serial numbers or DATE_FORMAT strings, and costs
+        numbers or strings.
+        """
+        import numpy as np
 
+        data = np.full((len(rows), len(HEADER)), "", dtype=object)
+        for row_ind, row in enumerate(rows):
+            data[row_ind, :len(row)] = row[:len(HEADER)]
+        columns = {}
+        columns["Date"] = cls.parse_dates(data[:, 0])
+        for column in cls.COST_COLUMNS:
+            columns[column] = cls.parse_costs(data[:, HEADER.index(column)])
+        for column in cls.TEXT_COLUMNS:
+            values, codes = np.unique(
+                data[:, HEADER.index(column)].astype(str),
+                return_inverse=True
+            )
+            columns[column] = (
+                codes.astype(np.min_scalar_type(len(values))), values
+            )
+        return cls(columns)
+
+    @staticmethod
+    def parse_dates(values):
+        """
+        Return an array of datetime64 days for an object array of
+        serial numbers. Only the dates saved as text, by older
+        versions or imported from a file, are parsed as strings.
+        """
+        import numpy as np
+        import pandas as pd
+
+        serials = pd.to_numeric(
+            pd.Series(values, dtype=object), errors="coerce"
+        ).to_numpy(dtype=float)
+        dates = np.full(len(values), np.datetime64("NaT"), "M8[D]")
+        numbers = ~np.isnan(serials)
+        dates[numbers] = np.datetime64(SERIAL_EPOCH, "D") + np.floor(
+            serials[numbers]
+        ).astype(np.int64)
+        text = ~numbers & (values != "")
+        if text.any():
+            dates[text] = pd.to_datetime(
+                pd.Series(values[text], dtype=str),
+                format=DATE_FORMAT,
+                errors="coerce"
+            ).to_numpy().astype("M8[D]")
+        return dates
+
+    @staticmethod
+    def parse_costs(values):
+        """
+        Return an array of float64 costs for an object array of
+        numbers. Only the costs saved as text, which may use a
+        decimal comma, are parsed as strings.
+        """
+        import numpy as np
+        import pandas as pd
+
+        costs = pd.to_numeric(
+            pd.Series(values, dtype=object), errors="coerce"
+        ).to_numpy(dtype=float)
+        text = np.isnan(costs) & (values != "")
+        if text.any():
+            costs[text] = pd.to_numeric(
+                pd.Series(values[text], dtype=str).str.replace(
+                    ",", ".", regex=False
+                ),
+                errors="coerce"
+            ).to_numpy(dtype=float)
+        return costs
+
+    def __len__(self):
+        return len(self.columns["Date"])
+
+    def text(self, column):
+        """
+        Return the values of a text column as an array of strings.
+        """
+        codes, values = self.columns[column]
+        return values[codes]
+
+    def take(self, selection):
+        """
+        Return a new batch with the rows selected by a boolean mask
+        or an array of indexes.
+        """
+        return ExpenseBatch({
+            column: (
+                (data[0][selection], data[1])
+                if column in self.TEXT_COLUMNS
+                else data[selection]
+            )
+            for column, data in self.columns.items()
+        })
+
+    def convert(self, chosen_currency):
+        """
+        Convert the costs to the chosen currency with the rates in
+        effect on their dates, looking up each currency once.
+        Blank or unparseable costs are counted as 0, as in the totals,
+        so that only costs without an exchange rate become NaN.
+        """
+        import numpy as np
+
+        codes, currencies = self.columns["Currency"]
+        self.columns["Cost_chosen_currency"] = convert_costs(
+            np.nan_to_num(self.columns["Cost"]),
+            currencies,
+            chosen_currency,
+            codes,
+            self.columns["Date"]
+        )
+        self.columns["Chosen_currency"] = (
+            np.zeros(len(self), dtype=np.uint8),
+            np.array([chosen_currency])
+        )
+
+    def rows(self):
+        """
+        Return the expenses as rows to save, in the HEADER order,
+        with serial number dates and costs in whole cents.
+        """
+        import numpy as np
+
+        dates = self.columns["Date"]
+        serials = (dates - np.datetime64(SERIAL_EPOCH, "D")).astype(np.int64)
+        serials = np.where(np.isnat(dates), "", serials.astype(object))
+        columns = [serials.tolist()] + [
+            self.text(column).tolist()
+            if column in self.TEXT_COLUMNS
+            else (np.rint(self.columns[column] * 100) / 100).tolist()
+            for column in HEADER[1:]
+        ]
+        return [list(row) for row in zip(*columns)]
+
+    def totals(self):
+        """
+        Return the running totals of the expenses, summing the
+        converted costs by name and concept code in whole cents.
+        """
+        import numpy as np
 
-def check_expense(update_worksheet, trip_name, expense, row_edit):
+        cents = np.rint(
+            np.nan_to_num(self.columns["Cost_chosen_currency"]) * 100
+        )  # Sums of whole numbers are exact as float64
+        totals = empty_totals()
+        totals["count"] = len(self)
+        totals["total"] = from_cents(int(cents.sum()))
+        for key, column in [("by_name", "Name"), ("by_concept", "Concept")]:
+            codes, values = self.columns[column]
+            sums = np.bincount(codes, weights=cents, minlength=len(values))
+            counts = np.bincount(codes, minlength=len(values))
+            totals[key] = {
+                value: [from_cents(int(total)), int(count)]
+                for value, total, count in zip(values.tolist(), sums, counts)
+                if count
+            }
+        return totals
+
+
+class TripEntries:
+    """
+    Expenses of a trip loaded to be browsed, with indexes built once
+    so that filtering a large trip doesn't go through every entry:
+    the positions of the entries of each name, concept and currency,
+    and the positions sorted by date to find a range by bisection.
+    """
+    INDEXED_COLUMNS = {
+        "name": "Name",
+        "concept": "Concept",
+        "currency": "Currency"
+    }
+    __slots__ = ("batch", "positions", "date_order", "sorted_dates")
+
+    def __init__(self, batch):
+        """
+        Build the indexes of the ExpenseBatch.
+        """
+        import numpy as np
+
+        self.batch = batch
+        self.positions = {}  # Column: {value: sorted positions}
+        for column in self.INDEXED_COLUMNS.values():
+            codes, values = batch.columns[column]
+            order = np.argsort(codes, kind="stable")
+            counts = np.bincount(codes, minlength=len(values))
+            self.positions[column] = dict(zip(
+                values.tolist(), np.split(order, np.cumsum(counts)[:-1])
+            ))
+        dates = batch.columns["Date"]
+        self.date_order = np.argsort(dates, kind="stable")  # NaT last
+        self.sorted_dates = dates[self.date_order]
+
+    def __len__(self):
+        return len(self.batch)
+
+    def select(self, filters):
+        """
+        Return the sorted positions of the entries matching all the
+        filters, a dictionary of the values returned by parse_filter.
+        Without filters, return the positions of all the entries.
+        """
+        import numpy as np
+
+        selected = np.arange(len(self))
+        for field, value in filters.items():
+            if field == "date":
+                first, last = value
+                positions = np.sort(self.date_order[
+                    np.searchsorted(self.sorted_dates, first, side="left"):
+                    np.searchsorted(self.sorted_dates, last, side="right")
+                ])
+            else:
+                positions = self.positions[self.INDEXED_COLUMNS[field]].get(
+                    value, np.array([], dtype=int)
+                )
+            selected = np.intersect1d(selected, positions, assume_unique=True)
+        return selected
+
+    def table(self, positions):
+        """
+        Return the entry number, date, name, concept, cost and
+        currency of the entries at the given positions, with the
+        dates in the DATE_FORMAT rather than as saved.
+        """
+        rows = self.batch.take(positions).rows()
+        return [
+            [position, serial_to_date(row[0])] + row[1:5]
+            for position, row in zip(positions.tolist(), rows)
+        ]
+
+
+def check_expense(update_worksheet, trip_name, expense, entry_ind):
     """
     Loop asking if the data entered is correct. The user has the possibility
     to change any field. Then the update_worksheet parameter will call the
     appropiate function so that the entry will be either added or edited.
     The user has the possibility to cancel at any time.
     """
+    getters = {
+        "date": get_date,
+        "name": get_name,
+        "concept": get_concept,
+        "cost": get_cost,
+        "currency": get_currency
+    }
     while True:
-        record = [
-            (attr, value) for attr, value in expense.__dict__.items()
-        ]  # Iterate over the attributes of the class
-        record_to_display = record[
-            1:
-        ]  # Index 0 is the trip name, which won't be added
         print(f"This is the record:\n")
-        print(tabulate(record_to_display))
+        print(tabulate(expense.fields()))
         print("Press Y if you want to confirm the expense")
         print("Press C if you want to cancel\n")
         print("If you want to make a change, enter name of the field.")
         field = input("Example: name\n")
-        if field.lower() == "date":
-            new_date = get_date(trip_name)
-            expense.date = new_date
-            clear_terminal()
-        elif field.lower() == "name":
-            new_name = get_name(trip_name)
-            expense.name = new_name
-            clear_terminal()
-        elif field.lower() == "concept":
-            new_concept = get_concept(trip_name)
-            expense.concept = new_concept
-            clear_terminal()
-        elif field.lower() == "cost":
-            new_cost = get_cost(trip_name)
-            expense.cost = new_cost
-            clear_terminal()
-        elif field.lower() == "currency":
-            new_currency = get_currency(trip_name)
-            expense.currency = new_currency
+        if field.lower() in getters:
+            setattr(expense, field.lower(), getters[field.lower()](trip_name))
             clear_terminal()
         elif field.lower() == "c":
             time.sleep(0.5)
             clear_terminal()
-            select_trip(trip_name)
+            raise Navigate(select_trip, trip_name)
         elif field.lower() == "y":
-            update_worksheet(trip_name, expense, row_edit)
+            try:
+                update_worksheet(trip_name, expense, entry_ind)
+            except ExchangeRateNotFound as e:
+                clear_terminal()
+                print(Fore.RED + f"{e}")
+                print("Please choose a different currency.\n")
+                continue
             break
         else:
             clear_terminal()
             print("The value entered is not valid. Please try again.\n")
 
 
-def write_new_expense(worksheet, expense, row_edit):
+@profiled
+def write_new_expense(trip_name, expense, entry_ind):
     """
-    Appends a new the expense to the trip spreadhseet.
+    Appends a new the expense to the trip storage.
     Call methods from expense class to get the exchange rate
     of the chosen currency.
     """
-    worksheet = SHEET.worksheet(worksheet)
-    expense_arr = [
-        value for attr, value in expense.__dict__.items()
-    ]  # Iterate over the attributes of the class
-    expense_arr_write = expense_arr[
-        1:
-    ]  # Index 0 is the trip name, which won't be added
-
-    exchange_rate = float(expense.get_exchange_rate().replace(",", "."))
-    cost_chosen_currency = (
-        expense_arr[4] * exchange_rate
-    )  # Index 4 is the cost
-
-    chosen_currency = expense.get_chosen_currency()
-
-    expense_arr_write.append(cost_chosen_currency)
-    expense_arr_write.append(chosen_currency)
-    worksheet.append_row(
-        expense_arr_write,
-        table_range="A:G"
-    )  # Need to specify range to avoid appending in wrong place
+    expense_arr_write = expense.to_row()
+    STORAGE.append_expense(trip_name, expense_arr_write)
+    update_totals(trip_name, added=[expense_arr_write])
 
 
+@profiled
 def load_trips():
     """
-    Print existing trips or load the welcome menu if there aren't any.
+    Print existing trips or go back to the welcome menu if there aren't any.
     The user can select one of the trips.
-    The function returns the name of the selected trip.
+    The function returns the trip menu of the selected trip.
     """
-    worksheets = SHEET.worksheets()
     trips = {
-        x + 1: worksheet.title for x, worksheet in enumerate(worksheets[1:])
+        x + 1: title for x, title in enumerate(STORAGE.trips())
     }
     options_arr = [key for key, value in trips.items()]
     options = ", ".join([str(key) for key, value in trips.items()])
@@ -469,8 +3654,9 @@ def load_trips():
         print("There are currently no trips\n")
         time.sleep(1.5)
         clear_terminal()
-        welcome_menu()
+        return (welcome_menu,)
     else:
+        PREFETCHER.start(list(trips.values()))
         clear_terminal()
         print("These are the existing trips:\n")
         print(
@@ -486,87 +3672,461 @@ def load_trips():
             user_choice = input(f"Enter your selection:\n")
             if user_choice.lower() == "c":
                 clear_terminal()
-                welcome_menu()
+                return (welcome_menu,)
             validated_choice = validate_user_choice(user_choice, options_arr)
             validated_choice_bool, validated_choice_num = validated_choice
             if validated_choice_bool:
                 selected_trip = trips[validated_choice_num]
-                select_trip(selected_trip)
+                return (select_trip, selected_trip)
 
 
+def load_trip_batch(trip_name):
+    """
+    Load the expenses of the trip into an ExpenseBatch.
+    """
+    return ExpenseBatch.from_values(STORAGE.get_trip_values(trip_name))
+
+
+def load_trip_entries(trip_name):
+    """
+    Load the expenses of the trip with the indexes used to browse them.
+    Values are parsed once here so that filtering the entries and
+    changing the page don't need to go through all of them.
+    """
+    return TripEntries(load_trip_batch(trip_name))
+
+
+def empty_totals():
+    """
+    Return the running totals of a trip without entries.
+    by_name and by_concept map each value to [total, number of entries].
+    """
+    return {"count": 0, "total": 0.0, "by_name": {}, "by_concept": {}}
+
+
+def add_to_totals(totals, row, sign=1):
+    """
+    Add (sign=1) or remove (sign=-1) one expense row to the running totals.
+    People and concepts without entries left are removed.
+    """
+    cents = sign * to_cents(
+        row[5]
+    )  # Index 5 is the cost in the chosen currency
+    totals["count"] += sign
+    totals["total"] = from_cents(
+        to_cents(totals["total"]) + cents
+    )  # Added in cents so that additions and removals don't add up errors
+    for key, value in [("by_name", row[1]), ("by_concept", row[2])]:
+        total, count = totals[key].get(value, [0.0, 0])
+        if count + sign == 0:
+            totals[key].pop(value, None)
+        else:
+            totals[key][value] = [
+                from_cents(to_cents(total) + cents), count + sign
+            ]
+
+
+def rebuild_totals(trip_name):
+    """
+    Compute the running totals of the trip from all its entries
+    and save them. Return the totals.
+    """
+    totals = load_trip_batch(trip_name).totals()
+    STORAGE.save_totals(trip_name, totals)
+    return totals
+
+
+def get_trip_totals(trip_name):
+    """
+    Return the running totals saved with the trip.
+    Trips created before totals were kept get them rebuilt once.
+    """
+    totals = STORAGE.get_totals(trip_name)
+    if totals is None:
+        totals = rebuild_totals(trip_name)
+    return totals
+
+
+def update_totals(trip_name, added=(), removed=()):
+    """
+    Update the running totals of the trip with the rows added and
+    removed, instead of computing them again from all the entries.
+    Called once the rows are saved: trips without totals get them
+    rebuilt from entries that already include the change.
+    """
+    totals = STORAGE.get_totals(trip_name)
+    if totals is None:
+        rebuild_totals(trip_name)
+        return
+    for row in removed:
+        add_to_totals(totals, row, sign=-1)
+    for row in added:
+        add_to_totals(totals, row)
+    STORAGE.save_totals(trip_name, totals)
+
+
+@profiled
+def check_totals(trip_names=None):
+    """
+    Rebuild the running totals of the given trips, or of all trips,
+    from their entries and report the ones that were out of date.
+    """
+    for trip_name in trip_names or STORAGE.trips():
+        saved = STORAGE.get_totals(trip_name)
+        rebuilt = rebuild_totals(trip_name)
+        consistent = saved is not None and (
+            saved["count"] == rebuilt["count"]
+            and round(saved["total"], 2) == round(rebuilt["total"], 2)
+            and all(
+                {
+                    value: [round(total, 2), count]
+                    for value, (total, count) in saved[key].items()
+                } == {
+                    value: [round(total, 2), count]
+                    for value, (total, count) in rebuilt[key].items()
+                }
+                for key in ["by_name", "by_concept"]
+            )
+        )
+        if consistent:
+            print(f"{trip_name}: totals are consistent.")
+        else:
+            print(Fore.YELLOW + f"{trip_name}: totals have been rebuilt.")
+
+
+def get_trips_overview():
+    """
+    Read every trip at once and return a list with the name,
+    number of entries, total cost, base currency and first and last
+    date of each trip.
+    """
+    import numpy as np
+
+    rows = []
+    for trip_name, (chosen_currency, data) in (
+        STORAGE.get_all_trips_values().items()
+    ):
+        batch = ExpenseBatch.from_values(data)
+        dates = batch.columns["Date"]
+        dates = dates[~np.isnat(dates)]
+        if len(dates):
+            first = dates.min().astype(datetime).strftime(DATE_FORMAT)
+            last = dates.max().astype(datetime).strftime(DATE_FORMAT)
+        else:
+            first = last = ""
+        rows.append((
+            trip_name,
+            len(batch),
+            round(float(np.nansum(batch.columns["Cost_chosen_currency"])), 2),
+            chosen_currency,
+            first,
+            last
+        ))
+    return rows
+
+
+def print_trips_overview():
+    """
+    Print a table with the entries, total cost and dates of all trips.
+    """
+    overview = get_trips_overview()
+    if not overview:
+        print("There are currently no trips\n")
+        return
+    print(
+        tabulate(
+            overview,
+            headers=["Trip", "Entries", "Total", "Currency", "From", "To"],
+            tablefmt="mixed_grid",
+            floatfmt=".2f"
+        )
+    )
+
+
+@profiled
+def see_dashboard():
+    """
+    Display the overview of all trips and go back to the welcome menu.
+    """
+    clear_terminal()
+    print("This is the overview of all your trips:\n")
+    print_trips_overview()
+    print("")
+    input("Enter any key to go back:\n")
+    clear_terminal()
+    return (welcome_menu,)
+
+
+def see_stats():
+    """
+    Display the Google Sheets requests made by each action during
+    the session and go back to the welcome menu.
+    """
+    clear_terminal()
+    print("These are the Google Sheets requests of this session:\n")
+    PROFILER.print_stats()
+    print("")
+    input("Enter any key to go back:\n")
+    clear_terminal()
+    return (welcome_menu,)
+
+
+@profiled
 def select_trip(trip_name):
     """
-    Select the worksheet containing the chosen trip.
+    Load the data of the chosen trip.
     The user is presented with the options to:
         1. See the summary of the trip.
         2. Edit the trip.
         3. Delete the trip.
+        4. See who has to pay whom to settle up.
+        5. Change the base currency of the trip.
+        6. Archive the trip.
     A loop runs until the option chosen is valid.
+    Only the running totals are read here, the entries are loaded
+    when they are needed to edit or delete the trip.
     """
-    worksheet = SHEET.worksheet(trip_name)
-    data = worksheet.get_all_values()
-    header = data[0]
-    rows = data[1:]
-    df = pd.DataFrame(rows, columns=header)
+    PREFETCHER.wait(trip_name)
+    totals = get_trip_totals(trip_name)
     clear_terminal()
     print(f"You have selected the {trip_name} trip.")
     print(
         "There is 1 entry.\n"
-        if df.shape[0] == 1
-        else f"There are {df.shape[0]} entries.\n"
+        if totals["count"] == 1
+        else f"There are {totals['count']} entries.\n"
     )
+    pending = STORAGE.pending_count(trip_name)
+    if pending:
+        print(
+            Fore.YELLOW +
+            f"{pending} of them not saved yet. "
+            "They will be saved when you go back.\n"
+        )
     print("What would you like to do?\n")
     print(
-        tabulate([[1, "See summary"], [2, "Edit trip"], [3, "Delete trip"]])
+        tabulate(
+            [
+                [1, "See summary"],
+                [2, "Edit trip"],
+                [3, "Delete trip"],
+                [4, "Settle up"],
+                [5, "Change base currency"],
+                [6, "Archive trip"]
+            ]
+        )
         + "\n"
     )
     while True:
         print("Please, enter the number of your prefered option:")
-        user_choice = input("1, 2, 3 or enter C to go back:\n")
-        validated_choice = validate_user_choice(user_choice, range(1, 4))
+        user_choice = input("1, 2, 3, 4, 5, 6 or enter C to go back:\n")
+        validated_choice = validate_user_choice(user_choice, range(1, 7))
         validated_choice_bool, validated_choice_num = validated_choice
         if validated_choice_bool or user_choice.lower() == "c":
             clear_terminal()
             if user_choice.lower() == "c":
-                load_trips()
+                STORAGE.flush(trip_name)
+                return (load_trips,)
             elif validated_choice_num == 1:
-                see_trip_summary(trip_name, df)
+                see_trip_summary(trip_name, totals)
                 print("")
                 input("Enter any key to go back:\n")
                 time.sleep(0.5)
-                select_trip(trip_name)
+                return (select_trip, trip_name)
             elif validated_choice_num == 2:
-                edit_trip(trip_name, df)
+                return (edit_trip, trip_name, load_trip_entries(trip_name))
             elif validated_choice_num == 3:
-                delete_trip(trip_name, df)
+                return (
+                    delete_trip, trip_name, load_trip_entries(trip_name)
+                )
+            elif validated_choice_num == 4:
+                see_settlement(trip_name, totals)
+                print("")
+                input("Enter any key to go back:\n")
+                time.sleep(0.5)
+                return (select_trip, trip_name)
+            elif validated_choice_num == 5:
+                return (change_base_currency, trip_name, totals)
+            elif validated_choice_num == 6:
+                return (archive_trip, trip_name)
+
+
+def rebase_values(values, chosen_currency):
+    """
+    Convert all the expenses of a trip, given as returned by
+    Storage.get_trip_values, to a new base currency in one
+    vectorized pass. Return the [cost, currency] rows of the
+    Cost_chosen_currency and Chosen_currency columns, and the
+    new running totals.
+    Raise ExchangeRateNotFound if a currency can't be converted.
+    """
+    import numpy as np
+
+    batch = ExpenseBatch.from_values(values)
+    batch.convert(chosen_currency)
+    costs = batch.columns["Cost_chosen_currency"]
+    if np.isnan(costs).any():
+        currency = batch.text("Currency")[np.isnan(costs)][0]
+        raise ExchangeRateNotFound(str(currency), chosen_currency)
+    converted = [[cost, chosen_currency] for cost in costs.tolist()]
+    return converted, batch.totals()
+
+
+@profiled
+def change_base_currency(trip_name, totals):
+    """
+    Ask for a new base currency and convert all the entries of the
+    trip to it, saving the converted costs, the currency and the
+    totals in a single request.
+    """
+    chosen_currency = STORAGE.chosen_currency(trip_name)
+    print(f"The base currency of the {trip_name} trip is {chosen_currency}.")
+    print("Select the new base currency.\n")
+    new_currency = get_currency(trip_name)  # C goes back to the trip menu
+    if new_currency == chosen_currency:
+        print(f"{new_currency} is already the base currency.")
+        time.sleep(1.5)
+        return (select_trip, trip_name)
+
+    entries = (
+        "The entry" if totals["count"] == 1
+        else f"All {totals['count']} entries"
+    )
+    print(
+        f"{entries} will be converted from {chosen_currency} "
+        f"to {new_currency}."
+    )
+    while True:
+        user_choice = input("Enter Y to convert them or N to cancel:\n")
+        if user_choice.lower() == "n":
+            clear_terminal()
+            return (select_trip, trip_name)
+        if user_choice.lower() == "y":
+            break
+        print(Fore.RED + "Invalid choice, please try again.\n")
+
+    try:
+        converted, new_totals = rebase_values(
+            STORAGE.get_trip_values(trip_name), new_currency
+        )
+    except ExchangeRateNotFound as e:
+        print(Fore.RED + f"{e}")
+        print("The base currency hasn't been changed.")
+        time.sleep(2)
+        return (select_trip, trip_name)
+    STORAGE.rebase_trip(trip_name, new_currency, converted, new_totals)
+    print(Fore.YELLOW + f"The base currency is now {new_currency}.")
+    time.sleep(1.5)
+    clear_terminal()
+    return (select_trip, trip_name)
 
 
-def see_trip_summary(trip_name, df):
+def get_spent_by_name(totals):
+    """
+    Return how much each person has paid, as a dictionary sorted by name,
+    and how much each person should pay so that everyone pays the same.
+    """
+    sum_by_name = {
+        name: total for name, (total, count) in sorted(
+            totals["by_name"].items()
+        )
+    }  # How much each person has paid
+    nr_of_persons = len(sum_by_name)
+    avg_cost = (
+        totals["total"] / nr_of_persons
+    )  # Calculate how much each person should pay
+    return sum_by_name, avg_cost
+
+
+def settle_balances(balances):
+    """
+    Work out the transfers that settle everyone's balance.
+    balances maps each name to the amount they have to receive (+)
+    or pay (-). Amounts are rounded to the cent, and the rounding
+    residue is given to the people whose balance was rounded the most,
+    so that the transfers add up exactly.
+    Debtors and creditors are matched greedily, largest first, using
+    two heaps. This takes O(n log n) and needs at most n - 1 transfers.
+    Return a list of (payer, payee, amount) tuples.
+    """
+    cents = {name: round(balance * 100) for name, balance in balances.items()}
+    residue = sum(cents.values())
+    if residue:
+        rounding = sorted(
+            balances,
+            key=lambda name: cents[name] - balances[name] * 100,
+            reverse=residue > 0
+        )
+        step = 1 if residue > 0 else -1
+        for name in rounding[:abs(residue)]:
+            cents[name] -= step
+
+    creditors = [(-amount, name) for name, amount in cents.items()
+                 if amount > 0]
+    debtors = [(amount, name) for name, amount in cents.items()
+               if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, payee = heapq.heappop(creditors)
+        debt, payer = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append((payer, payee, amount / 100))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, payee))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, payer))
+    return transfers
+
+
+@profiled
+def see_settlement(trip_name, totals):
+    """
+    Print the payments needed so that everyone has paid the same amount.
+    All displayed amounts have been converted to the user's currency.
+    """
+    if totals["count"] == 0:
+        print("There are no entries for this trip\n")
+        return
+
+    chosen_curr = STORAGE.chosen_currency(trip_name)
+    sum_by_name, avg_cost = get_spent_by_name(totals)
+    transfers = settle_balances(
+        {name: value - avg_cost for name, value in sum_by_name.items()}
+    )
+
+    if not transfers:
+        print(f"Everyone has paid the same for the {trip_name} trip.")
+        return
+
+    print(f"To settle up the {trip_name} trip:\n")
+    print(
+        tabulate(
+            transfers,
+            headers=["From", "To", f"Amount ({chosen_curr})"],
+            tablefmt="mixed_grid",
+            floatfmt=".2f"
+        )
+    )
+
+
+@profiled
+def see_trip_summary(trip_name, totals):
     """
     Print a table displaying how much each person spent.
     It also shows how much each has to pay/receive so that everyone
-    pays the same amount.
+    pays the same amount, and how much was spent on each concept.
     All displayed amounts have been converted to the user's currency.
     """
-    if df.shape[0] == 0:
+    if totals["count"] == 0:
         print("There are no entries for this trip\n")
 
     else:
-        chosen_curr = df["Chosen_currency"][0]
-        nr_of_persons = df["Name"].value_counts().shape[0]
-        df["Cost_chosen_currency"] = (
-            df["Cost_chosen_currency"].str.replace(",", ".").astype(float)
-        )  # Convert to float so that it can be added up
-        total_cost = df[
-            "Cost_chosen_currency"
-        ].sum()  # Calculate the total cost of the trip
+        chosen_curr = STORAGE.chosen_currency(trip_name)
+        total_cost = totals["total"]  # Total cost of the trip
         total_cost_rnd = round(total_cost, 2)
-        avg_cost = (
-            total_cost / nr_of_persons
-        )  # Calculate how much each person should pay
-        sum_by_name = df.groupby("Name")[
-            "Cost_chosen_currency"
-        ].sum()  # Calculate how much each person has paid
+        sum_by_name, avg_cost = get_spent_by_name(totals)
         sum_by_name_list = [
             (name, value) for name, value in sum_by_name.items()
         ]  # Create list to be displayed
@@ -598,17 +4158,30 @@ def see_trip_summary(trip_name, df):
                 numalign="center"
             )
         )
+        print("")
+        print(
+            tabulate(
+                [
+                    (concept, count, round(total, 2))
+                    for concept, (total, count) in sorted(
+                        totals["by_concept"].items()
+                    )
+                ],
+                headers=["Concept", "Entries", "Spent"],
+                tablefmt="mixed_grid",
+                numalign="center"
+            )
+        )
 
 
-def edit_trip(trip_name, df):
+@profiled
+def edit_trip(trip_name, entries):
     """
-    Show all entries for the selected trip. The user can choose between
-    deleting, editing or adding an entry.
+    Show the entries of the selected trip a page at a time. The user can
+    filter them, and choose between deleting, editing or adding an entry.
     """
-    options_array = [option for option in df.index.to_numpy()]
-    options_array_str = ", ".join([str(choice) for choice in options_array])
-    show_trip_entries(trip_name, df)
-    if df.shape[0] == 0:
+    if len(entries) == 0:
+        show_trip_entries(trip_name, entries)
         while True:
             print("Enter A to add an entry")
             user_choice = input("Or enter C to go back:\n")
@@ -618,68 +4191,105 @@ def edit_trip(trip_name, df):
             if user_choice.lower() == "c":
                 time.sleep(0.5)
                 clear_terminal()
-                select_trip(trip_name)
+                return (select_trip, trip_name)
             elif user_choice.lower() == "a":
                 clear_terminal()
                 print(f"You are creating a new entry for {trip_name}")
                 create_expense(trip_name)
                 print(Fore.YELLOW + "Expense added successfully!")
                 time.sleep(1)
-                select_trip(trip_name)
-    else:
-        while True:
-            print("Enter E to edit, D to delete, or A to add an entry.")
-            user_choice = input("Or enter C to go back:\n")
-            if user_choice.lower() not in ["e", "d", "a", "c"]:
-                print("")
+                return (select_trip, trip_name)
+
+    filters = {}
+    positions = entries.select(filters)
+    page = 0
+    while True:
+        if filters:
+            print(
+                f"{len(positions)} of {len(entries)} entries match "
+                + " ".join(
+                    f"{field}:{filter_text(field, value)}"
+                    for field, value in filters.items()
+                )
+                + "\n"
+            )
+        pages = show_trip_entries(trip_name, entries, positions, page)
+        print("Enter E to edit, D to delete, or A to add an entry.")
+        print("Enter S to select several entries to edit or delete.")
+        print("Enter N or P to change the page, or filter the entries")
+        print("with name:John, concept:Meals, currency:GBP or")
+        print("date:30/06/2023..02/07/2023, or X to clear the filters.")
+        user_choice = input("Or enter C to go back:\n").strip()
+        if user_choice.lower() == "c":
+            time.sleep(0.5)
+            clear_terminal()
+            return (select_trip, trip_name)
+        if user_choice.lower() == "e":
+            return edit_delete_entry(
+                len(entries),
+                trip_name,
+                edit_trip_entry,
+                option_chosen="edit"
+            )
+        if user_choice.lower() == "d":
+            return edit_delete_entry(
+                len(entries),
+                trip_name,
+                delete_trip_entry,
+                option_chosen="delete"
+            )
+        if user_choice.lower() == "s":
+            return select_several_entries(trip_name, entries)
+        if user_choice.lower() == "a":
+            clear_terminal()
+            print(f"You are creating a new entry for {trip_name}")
+            create_expense(trip_name)
+            print(Fore.YELLOW + "Expense added successfully!")
+            time.sleep(1)
+            return (select_trip, trip_name)
+        clear_terminal()
+        if user_choice.lower() in ["n", "p"]:
+            new_page = page + (1 if user_choice.lower() == "n" else -1)
+            if 0 <= new_page < pages:
+                page = new_page
+            else:
+                print(Fore.RED + "There are no more pages.\n")
+            continue
+        if user_choice.lower() == "x":
+            filters = {}
+        else:
+            try:
+                entry_filter = parse_filter(user_choice)
+            except ValueError:
+                entry_filter = None
+            if entry_filter is None:
                 print(Fore.RED + "Invalid choice, please try again.\n")
                 continue
-            if user_choice.lower() == "c":
-                time.sleep(0.5)
-                clear_terminal()
-                select_trip(trip_name)
-            if user_choice.lower() == "e":
-                edit_delete_entry(
-                    options_array,
-                    options_array_str,
-                    trip_name,
-                    edit_trip_entry,
-                    option_chosen="edit"
-                )
-            if user_choice.lower() == "d":
-                edit_delete_entry(
-                    options_array,
-                    options_array_str,
-                    trip_name,
-                    delete_trip_entry,
-                    option_chosen="delete"
-                )
-            if user_choice.lower() == "a":
-                clear_terminal()
-                print(f"You are creating a new entry for {trip_name}")
-                create_expense(trip_name)
-                print(Fore.YELLOW + "Expense added successfully!")
-                time.sleep(1)
-                select_trip(trip_name)
+            field, value = entry_filter
+            filters[field] = value
+        positions = entries.select(filters)
+        page = 0
 
 
 def edit_delete_entry(
-    options_array,
-    options_array_str,
+    entry_count,
     trip_name,
     edit_delete_trip_entry,
     option_chosen
 ):
     """
     Takes in the parameters necessary to either edit or delete an entry.
-    Validates the user choice and calls the appropiate function.
+    Validates the user choice and calls the appropiate function,
+    returning the screen it leads to.
+    The number of any entry of the trip is accepted, not only the ones
+    on the page shown.
     """
     while True:
-        print(f"Select the number of the entry you want to {option_chosen}:")
-        print(options_array_str)
+        print(f"Select the number of the entry you want to {option_chosen},")
+        print(f"from 0 to {entry_count - 1}:")
         user_choice_edit_entry = input("Enter one of the above options:\n")
         validated_choice = validate_user_choice(
-            user_choice_edit_entry, options_array
+            user_choice_edit_entry, range(entry_count)
         )
         validated_choice_bool, validated_choice_num = validated_choice
         if validated_choice_bool:
@@ -687,36 +4297,279 @@ def edit_delete_entry(
             print(
                 f"You will {option_chosen} entry number {validated_choice_num}"
             )
-            edit_delete_trip_entry(trip_name, validated_choice_num)
+            return edit_delete_trip_entry(trip_name, validated_choice_num)
 
 
-def show_trip_entries(trip_name, df):
+def parse_filter(selection):
     """
-    Check if the worksheet is empty.
-    If it's not empty displays the expenses.
+    Return the (field, value) tuple of a filter of the entries:
+    name:John, concept:Meals, currency:GBP, date:30/06/2023 or
+    date:30/06/2023..02/07/2023. The value of a date filter is
+    a (first, last) tuple of datetime64 days.
+    Return None if the selection isn't a filter, or raise ValueError
+    if its value isn't valid.
     """
-    relevant_columns = ["Date", "Name", "Concept", "Cost", "Currency"]
-    if df.shape[0] == 0:
-        print(f"The {trip_name} trip is empty.\n")
+    import numpy as np
+
+    field, separator, value = selection.strip().partition(":")
+    field = field.strip().lower()
+    if not separator or field not in ["name", "concept", "currency", "date"]:
+        return None
+    if field == "name":
+        value = validate_name(value)
+    elif field == "concept":
+        value = validate_concept(value)
+    elif field == "currency":
+        value = value.strip().upper()
+        if not value:
+            raise ValueError("The currency is empty.")
     else:
-        print(f"The {trip_name} trip contains the following entries:\n")
-        print(f"{df[relevant_columns]}\n")
+        first, _, last = value.partition("..")
+        first = datetime.strptime(validate_date(first), DATE_FORMAT)
+        last = datetime.strptime(validate_date(last or value), DATE_FORMAT)
+        value = (np.datetime64(first, "D"), np.datetime64(last, "D"))
+    return field, value
+
+
+def filter_text(field, value):
+    """
+    Return the value of a filter as it's typed.
+    """
+    if field != "date":
+        return value
+    first, last = [
+        day.astype(datetime).strftime(DATE_FORMAT) for day in value
+    ]
+    return first if first == last else f"{first}..{last}"
+
+
+def parse_selection(selection, entries):
+    """
+    Return the sorted entry indexes of the trip matching the selection
+    or raise ValueError.
+    The selection is a list of numbers and ranges, e.g. 3-10,14, or
+    a filter: name:John, concept:Meals, currency:GBP, date:30/06/2023
+    or date:30/06/2023..02/07/2023.
+    """
+    entry_filter = parse_filter(selection)
+    if entry_filter is None:
+        entry_inds = set()
+        for part in selection.split(","):
+            first, _, last = part.partition("-")
+            first = int(first)
+            last = int(last) if last else first
+            if not 0 <= first <= last < len(entries):
+                raise ValueError(f"{part.strip()} is not a valid range.")
+            entry_inds.update(range(first, last + 1))
+        return sorted(entry_inds)
+    entry_inds = entries.select(dict([entry_filter])).tolist()
+    if not entry_inds:
+        raise ValueError(f"No entries match {selection}.")
+    return entry_inds
+
+
+def select_several_entries(trip_name, entries):
+    """
+    The user selects several entries of the trip, by number or
+    with a filter, and chooses to delete them or edit one field
+    of all of them at once.
+    """
+    import numpy as np
+
+    print("Select the entries, by number or with a filter. Examples:")
+    print("3-10,14  name:John  concept:Meals  currency:GBP")
+    print("date:30/06/2023..02/07/2023")
+    while True:
+        selection = input("Enter the selection or C to cancel:\n")
+        if selection.lower() == "c":
+            clear_terminal()
+            return (select_trip, trip_name)
+        try:
+            entry_inds = parse_selection(selection, entries)
+            break
+        except ValueError:
+            print(
+                Fore.RED + "The selection is not valid, please try again.\n"
+            )
+
+    clear_terminal()
+    show_trip_entries(trip_name, entries, np.array(entry_inds))
+    print(f"{entries_count(len(entry_inds))} selected.")
+    while True:
+        print("Enter D to delete them, or E to change the date, name")
+        user_choice = input("or concept of all of them, or C to cancel:\n")
+        if user_choice.lower() not in ["d", "e", "c"]:
+            print(Fore.RED + "Invalid choice, please try again.\n")
+            continue
+        if user_choice.lower() == "c":
+            clear_terminal()
+            return (select_trip, trip_name)
+        if user_choice.lower() == "d":
+            return delete_trip_entries(trip_name, entry_inds)
+        if user_choice.lower() == "e":
+            return edit_trip_entries(trip_name, entry_inds)
+
+
+def entries_count(count):
+    """
+    Return the number of entries as text, such as 1 entry or 3 entries.
+    """
+    return "1 entry" if count == 1 else f"{count} entries"
+
 
+def confirm_entries_change(action):
+    """
+    Ask the user to confirm the change of the selected entries.
+    Return True if confirmed.
+    """
+    while True:
+        user_choice = input(
+            "Enter "
+            + Fore.RED + f"Y to {action} them"
+            + Fore.RESET + " or N to cancel:\n"
+        )
+        if user_choice.lower() in ["y", "n"]:
+            return user_choice.lower() == "y"
+        print(
+            Fore.RED +
+            f"{user_choice} is not a valid choice, please try again."
+        )
+
+
+@profiled
+def delete_trip_entries(trip_name, entry_inds):
+    """
+    Delete the selected entries in a single request after
+    the user confirms it.
+    """
+    print(f"You are going to delete {entries_count(len(entry_inds))}.")
+    if confirm_entries_change("delete"):
+        rows = STORAGE.get_trip_values(trip_name)[1:]
+        removed = [rows[entry_ind] for entry_ind in entry_inds]
+        STORAGE.delete_expenses(trip_name, entry_inds)
+        update_totals(trip_name, removed=removed)
+        print(Fore.YELLOW + "Entries successfully deleted.")
+        time.sleep(1)
+    clear_terminal()
+    return (select_trip, trip_name)
+
+
+@profiled
+def edit_trip_entries(trip_name, entry_inds):
+    """
+    Change the date, name or concept of the selected entries
+    in a single request after the user confirms it.
+    A new date changes the exchange rate of each expense, so their
+    costs are converted again with the rates in effect on that date.
+    Costs and currencies are edited one entry at a time.
+    """
+    getters = {
+        1: ("date", get_date),
+        2: ("name", get_name),
+        3: ("concept", get_concept)
+    }
+    print("Which field do you want to change?")
+    print("1. Date\n2. Name\n3. Concept\n")
+    while True:
+        user_choice = input("Enter 1, 2, 3 or C to cancel:\n")
+        if user_choice.lower() == "c":
+            clear_terminal()
+            return (select_trip, trip_name)
+        validated_choice = validate_user_choice(user_choice, getters)
+        validated_choice_bool, validated_choice_num = validated_choice
+        if validated_choice_bool:
+            break
+    clear_terminal()
+    field, getter = getters[validated_choice_num]
+    value = getter(trip_name)  # Entering C goes back to the trip menu
+    saved_value = date_to_serial(value) if field == "date" else value
+
+    rows = STORAGE.get_trip_values(trip_name)[1:]
+    removed = [rows[entry_ind] for entry_ind in entry_inds]
+    updates = {}
+    for entry_ind, row in zip(entry_inds, removed):
+        row = list(row)
+        row[validated_choice_num - 1] = saved_value
+        for column in [3, 5]:  # Older versions saved costs as text
+            row[column] = from_cents(to_cents(row[column]))
+        updates[entry_ind] = row
+
+    if field == "date":
+        import numpy as np
+
+        chosen_currency = STORAGE.chosen_currency(trip_name)
+        batch = ExpenseBatch.from_rows(list(updates.values()))
+        batch.convert(chosen_currency)
+        costs = batch.columns["Cost_chosen_currency"]
+        if np.isnan(costs).any():
+            currency = batch.text("Currency")[np.isnan(costs)][0]
+            print(
+                Fore.RED + f"{ExchangeRateNotFound(currency, chosen_currency)}"
+            )
+            time.sleep(2)
+            clear_terminal()
+            return (select_trip, trip_name)
+        for row, cost in zip(updates.values(), costs.tolist()):
+            row[5] = cost  # Index 5 is the cost in the chosen currency
+
+    print(
+        f"The {field} of {entries_count(len(entry_inds))} will be {value}."
+    )
+    if confirm_entries_change("edit"):
+        STORAGE.update_expenses(trip_name, updates)
+        update_totals(
+            trip_name, added=list(updates.values()), removed=removed
+        )
+        print(Fore.YELLOW + "Entries successfully edited.")
+        time.sleep(1)
+    clear_terminal()
+    return (select_trip, trip_name)
+
+
+def show_trip_entries(trip_name, entries, positions=None, page=0):
+    """
+    Check if the trip is empty.
+    If it's not empty displays a page of the entries at the given
+    positions, all the entries of the trip by default. Only the
+    entries on the page are formatted, however large the trip is.
+    Return the number of pages.
+    """
+    import numpy as np
+
+    if len(entries) == 0:
+        print(f"The {trip_name} trip is empty.\n")
+        return 0
+    if positions is None:
+        positions = np.arange(len(entries))
+    pages = max(1, math.ceil(len(positions) / ENTRY_PAGE_SIZE))
+    shown = positions[page * ENTRY_PAGE_SIZE:(page + 1) * ENTRY_PAGE_SIZE]
+    if len(shown) == 0:
+        print("No entries match the filters.\n")
+        return pages
+    print(f"The {trip_name} trip contains the following entries:\n")
+    print(
+        tabulate(
+            entries.table(shown),
+            headers=["Entry", "Date", "Name", "Concept", "Cost", "Currency"],
+            tablefmt="mixed_grid",
+            floatfmt=".2f"
+        )
+    )
+    print(f"Page {page + 1} of {pages}.\n")
+    return pages
 
+
+@profiled
 def delete_trip_entry(trip_name, entry_ind):
     """
     The user can select an entry from the trip to delete.
     A summary of the selected entry will be displayed and the user
     must confirm that the entry should be deleted.
     """
-    worksheet = SHEET.worksheet(trip_name)
-    row_delete = (
-        entry_ind + 2
-    )  # +2 because worksheet starts at 1 and the first line is the header
-    values_list = worksheet.row_values(row_delete)
-    header = ["Date", "Name", "Concept", "Cost", "Currency"]
+    values_list = STORAGE.get_expense(trip_name, entry_ind)
+    expense = Expense.from_row(trip_name, values_list)
     print("You are going to delete the following expense:")
-    print(tabulate(zip(header, values_list)))
+    print(tabulate(expense.fields()))
     while True:
         user_choice = input(
             "Enter "
@@ -729,69 +4582,60 @@ def delete_trip_entry(trip_name, entry_ind):
                 f"{user_choice} is not a valid choice, please try again."
             )
         elif user_choice.lower() == "y":
-            worksheet.delete_rows(row_delete)
+            STORAGE.delete_expense(trip_name, entry_ind)
+            update_totals(trip_name, removed=[values_list])
             print(Fore.YELLOW + "Entry successfully deleted.")
             time.sleep(1)
             clear_terminal()
-            select_trip(trip_name)
+            return (select_trip, trip_name)
         elif user_choice.lower() == "n":
-            select_trip(trip_name)
+            return (select_trip, trip_name)
 
 
+@profiled
 def edit_trip_entry(trip_name, entry_ind):
     """
     The user can select an entry from the trip to edit.
     A summary of the selected entry will be displayed and the user
     must confirm that the entry should be edited.
     """
-    worksheet = SHEET.worksheet(trip_name)
-    row_edit = (
-        entry_ind + 2
-    )  # +2 because worksheet starts at 1 and the first line is the header
-    values_list = worksheet.row_values(row_edit)
-    date = values_list[0]
-    name = values_list[1]
-    concept = values_list[2]
-    cost = float(values_list[3].replace(",", "."))  # Convert to float from str
-    currency = values_list[4]
-    expense = Expense(trip_name, date, name, concept, cost, currency)
+    values_list = STORAGE.get_expense(trip_name, entry_ind)
+    expense = Expense.from_row(trip_name, values_list)
 
-    check_expense(overwrite_expense, trip_name, expense, row_edit)
+    check_expense(
+        functools.partial(overwrite_expense, old_values=values_list),
+        trip_name,
+        expense,
+        entry_ind
+    )  # The row read here is the one replaced, so it isn't read again
     time.sleep(1.5)
     clear_terminal()
-    select_trip(trip_name)
+    return (select_trip, trip_name)
 
 
-def overwrite_expense(worksheet, expense, row_edit):
+@profiled
+def overwrite_expense(trip_name, expense, entry_ind, old_values):
     """
-    Overwrites the existing expense in the trip worksheet.
+    Overwrites the existing expense in the trip storage.
+    old_values is the row being overwritten.
     """
-    worksheet = SHEET.worksheet(worksheet)
-    expense_arr = [value for attr, value in expense.__dict__.items()]
-    expense_arr_write = expense_arr[
-        1:
-    ]  # Index 0 is the trip name, which won't be added
-
-    exchange_rate = float(expense.get_exchange_rate().replace(",", "."))
-    cost_chosen_currency = (
-        expense_arr[4] * exchange_rate
-    )  # Index 4 is the cost
-    chosen_currency = expense.get_chosen_currency()
-
-    expense_arr_write.append(cost_chosen_currency)
-    expense_arr_write.append(chosen_currency)
-
-    worksheet.update(f"A{row_edit}:G{row_edit}", [expense_arr_write])
+    expense_arr_write = expense.to_row()
+    STORAGE.update_expense(
+        trip_name, entry_ind, expense_arr_write, old_row=old_values
+    )
+    update_totals(
+        trip_name, added=[expense_arr_write], removed=[old_values]
+    )
     print(Fore.YELLOW + "Expense successfully edited!")
 
 
-def delete_trip(trip_name, df):
+@profiled
+def delete_trip(trip_name, entries):
     """
-    Display the trip entries and ask for the user confirmation
-    before deleting it.
+    Display the first page of the trip entries and ask for the user
+    confirmation before deleting it.
     """
-    worksheet = SHEET.worksheet(trip_name)
-    show_trip_entries(trip_name, df)
+    show_trip_entries(trip_name, entries)
     print(f"Are you sure you want to delete it?\n")
     print(Fore.YELLOW + "This action is not reversible")
     while True:
@@ -803,20 +4647,531 @@ def delete_trip(trip_name, df):
         if user_choice.lower() not in ["y", "n"]:
             print(Fore.RED + "Invalid choice, please try again.\n")
         elif user_choice.lower() == "n":
-            select_trip(trip_name)
+            return (select_trip, trip_name)
         elif user_choice.lower() == "y":
-            SHEET.del_worksheet(worksheet)
+            STORAGE.delete_trip(trip_name)
             print(Fore.YELLOW + f"{trip_name} successfully deleted!")
             time.sleep(2)
             clear_terminal()
-            welcome_menu()
+            return (welcome_menu,)
+
+
+def archive_path(trip_name):
+    """
+    Return the path of the archive file of the trip in ARCHIVE_DIR.
+    Characters that can't be used in file names are replaced.
+    """
+    file_name = "".join(
+        char if char.isalnum() or char in " -_" else "_"
+        for char in trip_name
+    )
+    return os.path.join(ARCHIVE_DIR, f"{file_name}.jsonl.gz")
+
+
+def save_archive(trip_name):
+    """
+    Save the trip to a gzip compressed JSON Lines file and remove it
+    from the storage. The first line describes the trip, with its
+    base currency and running totals, and each following line holds
+    an expense row as the storage returns it.
+    Return the path of the file, or None if it couldn't be archived.
+    """
+    path = archive_path(trip_name)
+    if os.path.exists(path):
+        print(Fore.RED + f"{path} already exists.")
+        return None
+    if not STORAGE.trip_exists(trip_name):
+        print(Fore.RED + f"{TripNotFound(trip_name)}")
+        return None
+
+    STORAGE.flush(trip_name)
+    STORAGE.prefetch([trip_name])  # Values, currency and totals at once
+    values = STORAGE.get_trip_values(trip_name)
+    info = {
+        "trip": trip_name,
+        "chosen_currency": STORAGE.chosen_currency(trip_name),
+        "entries": len(values) - 1,
+        "totals": get_trip_totals(trip_name),
+        "archived": datetime.now().isoformat(timespec="seconds")
+    }
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with gzip.open(
+        f"{path}.tmp", "wt", compresslevel=6, encoding="utf-8"
+    ) as file:
+        file.write(json.dumps(info) + "\n")
+        file.writelines(
+            json.dumps(row) + "\n" for row in values[1:]
+        )  # Index 0 is the header
+    os.replace(f"{path}.tmp", path)  # The trip is removed once it's saved
+    STORAGE.delete_trip(trip_name)
+    print(Fore.YELLOW + f"{trip_name} archived to {path}.")
+    return path
+
+
+def read_archive_info(path):
+    """
+    Return the description of the trip saved in an archive file.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return json.loads(file.readline())
+
+
+def list_archives():
+    """
+    Return a list of (path, description) tuples with the archived
+    trips, the most recently archived first.
+    """
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    archives = [
+        (path, read_archive_info(path))
+        for path in (
+            os.path.join(ARCHIVE_DIR, file_name)
+            for file_name in os.listdir(ARCHIVE_DIR)
+            if file_name.endswith(".jsonl.gz")
+        )
+    ]
+    return sorted(
+        archives, key=lambda archive: archive[1]["archived"], reverse=True
+    )
+
+
+def restore_archive(path):
+    """
+    Create the trip saved in an archive file again, with its entries
+    and running totals, and delete the file.
+    Dates and costs saved as text by older versions are parsed as
+    when a trip is loaded, so they are saved as numbers.
+    Return the name of the trip, or None if it couldn't be restored.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        info = json.loads(file.readline())
+        rows = [json.loads(line) for line in file]
+    trip_name = info["trip"]
+    if STORAGE.trip_exists(trip_name):
+        print(
+            Fore.RED + f"The {trip_name} trip already exists. "
+            "Rename or delete it before restoring the archived one."
+        )
+        return None
+
+    parsed = ExpenseBatch.from_rows(rows).rows()
+    rows = [
+        [
+            value if value != "" and value == value else original
+            for value, original in zip(parsed_row, row)
+        ]  # Values that can't be parsed, blank or NaN, are kept as they are
+        for parsed_row, row in zip(parsed, rows)
+    ]
+    STORAGE.create_trip(trip_name, info["chosen_currency"])
+    if rows:
+        try:
+            STORAGE.append_expenses(trip_name, rows)
+        except ValueError as e:  # A date the storage can't save
+            STORAGE.delete_trip(trip_name)
+            print(Fore.RED + f"The {trip_name} trip can't be restored: {e}")
+            return None
+    STORAGE.save_totals(trip_name, info["totals"])
+    STORAGE.flush(trip_name)
+    os.remove(path)
+    print(Fore.YELLOW + f"{trip_name} successfully restored!")
+    return trip_name
+
+
+@profiled
+def archive_trip(trip_name):
+    """
+    Ask for the user confirmation before archiving the trip.
+    Archived trips are listed in the welcome menu,
+    where they can be restored.
+    """
+    print(
+        f"The {trip_name} trip will be saved to {archive_path(trip_name)}"
+    )
+    print("and removed from the list of trips.\n")
+    print("It can be restored from the Archived trips option")
+    print("of the welcome menu.\n")
+    while True:
+        user_choice = input("Enter Y to archive it or N to cancel:\n")
+        if user_choice.lower() not in ["y", "n"]:
+            print(Fore.RED + "Invalid choice, please try again.\n")
+        elif user_choice.lower() == "n":
+            return (select_trip, trip_name)
+        elif user_choice.lower() == "y":
+            path = save_archive(trip_name)
+            time.sleep(2)
+            clear_terminal()
+            if path is None:
+                return (select_trip, trip_name)
+            return (welcome_menu,)
+
+
+@profiled
+def see_archives():
+    """
+    Display the archived trips and restore the one chosen by the user.
+    Go back to the welcome menu if there aren't any.
+    """
+    archives = list_archives()
+    if not archives:
+        print("There are currently no archived trips\n")
+        time.sleep(1.5)
+        clear_terminal()
+        return (welcome_menu,)
+
+    print("These are the archived trips:\n")
+    print(
+        tabulate(
+            [
+                (
+                    archive_num,
+                    info["trip"],
+                    info["entries"],
+                    info["totals"]["total"],
+                    info["chosen_currency"],
+                    datetime.fromisoformat(info["archived"]).strftime(
+                        DATE_FORMAT
+                    )
+                )
+                for archive_num, (path, info) in enumerate(archives, 1)
+            ],
+            headers=["", "Trip", "Entries", "Total", "Currency", "Archived"],
+            tablefmt="mixed_grid",
+            floatfmt=".2f"
+        )
+    )
+    print("")
+    while True:
+        print("Enter the number of the trip you want to restore")
+        user_choice = input("or enter C to go back:\n")
+        if user_choice.lower() == "c":
+            clear_terminal()
+            return (welcome_menu,)
+        validated_choice = validate_user_choice(
+            user_choice, range(1, len(archives) + 1)
+        )
+        validated_choice_bool, validated_choice_num = validated_choice
+        if validated_choice_bool:
+            path, info = archives[validated_choice_num - 1]
+            print(f"Restoring {info['trip']}...\n")
+            trip_name = restore_archive(path)
+            if trip_name is not None:
+                time.sleep(1.5)
+                return (select_trip, trip_name)
+
+
+def compact_trips(trip_names=None):
+    """
+    Free the space the given trips, or all trips, don't use
+    in the storage and report the ones that were compacted.
+    """
+    trip_names = trip_names or STORAGE.trips()
+    freed = STORAGE.compact(trip_names)
+    for trip_name in trip_names:
+        if trip_name in freed:
+            print(
+                Fore.YELLOW +
+                f"{trip_name}: {freed[trip_name]} unused cells removed."
+            )
+        else:
+            print(f"{trip_name}: nothing to compact.")
+
+
+def read_expense_file(path, errors):
+    """
+    Read the expenses of a CSV file, a JSON file containing a list
+    or a JSON Lines file, one record at a time.
+    Yield tuples with the line (or list position) and the record.
+    JSON Lines lines that can't be parsed are added to the errors
+    list as (line, error, text) and skipped.
+    """
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        if path.lower().endswith(".csv"):
+            reader = csv.DictReader(file)
+            for record in reader:
+                yield reader.line_num, record
+        elif file.read(1024).lstrip().startswith("["):
+            file.seek(0)
+            for position, record in enumerate(json.load(file), start=1):
+                yield position, record
+        else:
+            file.seek(0)
+            for line, text in enumerate(file, start=1):
+                if text.strip():
+                    try:
+                        record = json.loads(text)
+                    except ValueError as e:
+                        errors.append((line, f"{e}", text.strip()))
+                        continue
+                    yield line, record
+
+
+def validate_expense_record(record):
+    """
+    Validate an imported record with the same rules used
+    when the user enters an expense.
+    Return the Date, Name, Concept, Cost and Currency values
+    or raise ValueError.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("The record is not an object.")
+    record = {
+        str(key).strip().lower(): str(value)
+        for key, value in record.items()
+        if value is not None
+    }
+    validators = [
+        validate_date,
+        validate_name,
+        validate_concept,
+        validate_cost,
+        validate_currency
+    ]
+    values = []
+    for field, validator in zip(HEADER, validators):
+        if field.lower() not in record:
+            raise ValueError(f"The {field} column is missing.")
+        try:
+            values.append(validator(record[field.lower()]))
+        except ValueError:
+            raise ValueError(
+                f"{record[field.lower()]!r} is not a valid {field.lower()}."
+            ) from None
+    return values
+
+
+def convert_costs(
+    costs, currencies, chosen_currency, currency_codes=None, dates=None
+):
+    """
+    Convert all costs to the chosen currency in a single vectorized
+    operation. Each currency is looked up once in the exchange rates.
+    The currencies can also be given once each, with currency_codes
+    holding the index of the currency of each cost.
+    If an array of datetime64 dates is given, each cost is converted
+    with the rate in effect on its date, else with the latest rate.
+    Return an array of converted costs in whole cents, with NaN where
+    there's no rate.
+    """
+    import numpy as np
+
+    if currency_codes is None:
+        currencies, currency_codes = np.unique(
+            np.asarray(currencies, dtype=str), return_inverse=True
+        )
+    if dates is None:
+        dates = np.full(len(currency_codes), np.datetime64("NaT"), "M8[D]")
+    rates = np.full(len(currency_codes), np.nan)
+    for code, currency in enumerate(currencies):
+        rows = currency_codes == code
+        try:
+            rates[rows] = EXCHANGE_RATES.get_rates(
+                currency, chosen_currency, dates[rows]
+            )
+        except ExchangeRateNotFound:
+            pass  # Left as NaN
+    return np.rint(np.asarray(costs, dtype=float) * rates * 100) / 100
+
+
+@profiled
+def import_expenses(trip_name, path, report_path=None):
+    """
+    Import the expenses of a CSV or JSON file into an existing trip.
+    Valid rows are converted to the trip currency and saved in a
+    single batch. Invalid rows are skipped and written to a report.
+    """
+    try:
+        chosen_currency = STORAGE.chosen_currency(trip_name)
+    except TripNotFound as e:
+        print(Fore.RED + f"{e}")
+        return
+
+    import numpy as np
+
+    lines = []
+    rows = []
+    errors = []
+    for line, record in read_expense_file(path, errors):
+        try:
+            rows.append(validate_expense_record(record))
+            lines.append(line)
+        except ValueError as e:
+            errors.append((line, f"{e}", json.dumps(record)))
+
+    batch = ExpenseBatch.from_rows(rows)
+    batch.convert(chosen_currency)
+    no_rate = np.isnan(batch.columns["Cost_chosen_currency"])
+    for row_ind in np.flatnonzero(no_rate):
+        errors.append((
+            lines[row_ind],
+            f"{ExchangeRateNotFound(rows[row_ind][4], chosen_currency)}",
+            json.dumps(rows[row_ind])
+        ))  # Index 4 is the currency
+    rows_write = batch.take(~no_rate).rows()
+
+    if rows_write:
+        STORAGE.append_expenses(trip_name, rows_write)
+        update_totals(trip_name, added=rows_write)
+        STORAGE.flush(trip_name)
+    print(
+        Fore.YELLOW +
+        f"{len(rows_write)} expenses imported into the {trip_name} trip."
+    )
+
+    if errors:
+        report_path = report_path or f"{path}.errors.csv"
+        with open(report_path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["Line", "Error", "Record"])
+            writer.writerows(sorted(errors))
+        print(
+            Fore.RED + f"{len(errors)} rows were skipped. "
+            f"See {report_path} for details."
+        )
+
+
+def save_pending():
+    """
+    Save the expense rows still pending when the program ends.
+    """
+    try:
+        STORAGE.flush()
+    except (StorageUnavailable, TripChanged) as e:
+        print(Fore.YELLOW + f"{e}")
 
 
 def main():
     """
     Run the programm.
     """
-    welcome_menu()
+    parser = argparse.ArgumentParser(
+        description="Track trip expenses and split them between people."
+    )
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="report the import time and the time to open the storage "
+        "chosen with --storage, and exit"
+    )
+    parser.add_argument(
+        "--storage",
+        choices=["sheets", "sqlite"],
+        default=STORAGE_BACKEND,
+        help="where trips are saved (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--database",
+        default=SQLITE_PATH,
+        help="SQLite database file used by --storage sqlite"
+    )
+    parser.add_argument(
+        "--write-behind",
+        action="store_true",
+        default=WRITE_BEHIND,
+        help="save new and edited expenses in batches"
+    )
+    parser.add_argument(
+        "--journal",
+        default=JOURNAL_PATH,
+        help="journal file of the changes sent to Google Sheets, "
+        "or an empty value to disable it (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write the Google Sheets requests of each action to "
+        f"{PROFILE_PATH} on exit, in trace event format"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    import_parser = subparsers.add_parser(
+        "import",
+        help="import expenses from a CSV, JSON or JSON Lines file"
+    )
+    import_parser.add_argument("trip", help="name of an existing trip")
+    import_parser.add_argument("file", help="file with the expenses")
+    import_parser.add_argument(
+        "--report",
+        help="where to write the rows that couldn't be imported"
+    )
+    subparsers.add_parser(
+        "report",
+        help="print the entries, total cost and dates of all trips"
+    )
+    check_parser = subparsers.add_parser(
+        "check-totals",
+        help="rebuild the running totals of the trips from their entries"
+    )
+    check_parser.add_argument(
+        "trips", nargs="*", help="trips to check (default: all)"
+    )
+    archive_parser = subparsers.add_parser(
+        "archive",
+        help=f"save trips to compressed files in {ARCHIVE_DIR} "
+        "and remove them"
+    )
+    archive_parser.add_argument("trips", nargs="+", help="trips to archive")
+    restore_parser = subparsers.add_parser(
+        "restore",
+        help="create archived trips again from their files"
+    )
+    restore_parser.add_argument(
+        "files", nargs="+", help="archive files of the trips"
+    )
+    compact_parser = subparsers.add_parser(
+        "compact",
+        help="remove the unused rows and columns of the trip worksheets"
+    )
+    compact_parser.add_argument(
+        "trips", nargs="*", help="trips to compact (default: all)"
+    )
+    args = parser.parse_args()
+
+    if args.startup_profile:
+        startup_profile(args.storage, args.database)
+        return
+
+    global STORAGE
+    if args.storage == "sqlite":
+        STORAGE = SQLiteStorage(args.database)
+    if args.storage == "sheets":
+        atexit.register(SCHEDULER.report)
+    if args.profile:
+        PROFILER.enable_tracing()
+        atexit.register(PROFILER.write, PROFILE_PATH)
+    if args.write_behind:
+        STORAGE = WriteBehindStorage(STORAGE)
+    if args.storage == "sheets" and args.journal:
+        # SQLite saves each change in a transaction, so only
+        # Google Sheets needs the journal
+        STORAGE = JournalStorage(STORAGE, args.journal)
+    atexit.register(save_pending)
+
+    if isinstance(STORAGE, JournalStorage):
+        STORAGE.replay()
+    try:
+        if args.command == "import":
+            import_expenses(args.trip, args.file, args.report)
+        elif args.command == "report":
+            print_trips_overview()
+        elif args.command == "check-totals":
+            check_totals(args.trips)
+        elif args.command == "archive":
+            for trip_name in args.trips:
+                save_archive(trip_name)
+        elif args.command == "restore":
+            for path in args.files:
+                restore_archive(path)
+        elif args.command == "compact":
+            compact_trips(args.trips)
+        else:
+            try:
+                run_screens(welcome_menu)
+            finally:
+                PREFETCHER.cancel()
+    except StorageUnavailable as e:
+        # Reads would fail too, so the session ends here
+        print(Fore.YELLOW + f"{e}")
 
 
-main()
+if __name__ == "__main__":
+    main()